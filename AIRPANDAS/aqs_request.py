@@ -1,13 +1,39 @@
 import requests
 import json
-import PySimpleGUI as sg
+try:
+    import PySimpleGUI as sg
+except ImportError: ## headless workers only need AQSClient, which never opens a window
+    sg = None
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import threading
 import time
+import os
+import logging
 import pandas as pd
+import data_sinks
 
 ## this is the base url for the aqs api, and functions handle the request for the api
 base_url = "https://aqs.epa.gov/data/api/"
 
+logger = logging.getLogger(__name__)
+
+def read_api_key(file_name = "aqsEmailKey.txt"):
+    '''
+    read the email and api key from a file, without any prompt
+    require the first line to be email and second line to be api key
+
+    :param file_name: the file name of the file containing email and api key
+    :return: email and api key in a tuple
+    '''
+    # read the first two lines of the file -- email and api key
+    with open(file_name, "r") as file:
+        email = file.readline().strip()
+        api_key = file.readline().strip()
+
+    return email, api_key
+
 def get_api_key(file_name = "aqsEmailKey.txt"):
     '''
     obtain the email and api key from a file
@@ -19,10 +45,7 @@ def get_api_key(file_name = "aqsEmailKey.txt"):
     :return: email and api key in a tuple
     '''
     try: 
-        # read the first two lines of the file -- email and api key
-        with open(file_name, "r") as file:
-            email = file.readline().strip()
-            api_key = file.readline().strip()
+        email, api_key = read_api_key(file_name)
 
     except FileNotFoundError:
         # Prompt the user to enter their email and API key
@@ -131,10 +154,12 @@ def complete_params(params_requirement, input_values = None):
 
     return params
 
-def get_data(goal,params):
+def get_data(goal, params, cache=None, rate_limiter=None):
     '''
     Complete request pull from AQS API with a give goal
     :param goal: the goal of the request (e.g. "Daily by State")
+    :param cache: a ResponseCache to serve repeated requests from disk (optional)
+    :param rate_limiter: a RateLimiter to wait on before hitting the network (optional, cache hits never wait)
 
     return a request object of the data --- to be converted in data_processing
 
@@ -144,11 +169,25 @@ def get_data(goal,params):
     complete_params()
     '''
     endpoint = get_endpoint(goal)
+    url = base_url + endpoint
+
+    if cache is not None:
+        cached_response = cache.get(url, params)
+        if cached_response is not None:
+            return cached_response
+
+    if rate_limiter is not None:
+        rate_limiter.acquire()
 
-    response = requests.get(base_url + endpoint, params = params)
+    response = requests.get(url, params = params)
 
     #debug print
     #print(response.url)
+
+    if cache is not None:
+        # closed historical periods are kept forever, recent ones expire
+        period_end = datetime.strptime(params['edate'], '%Y%m%d') if params.get('edate') else None
+        cache.put(url, params, response, ttl=cache.ttl_for(period_end))
     
     return response
 
@@ -214,8 +253,23 @@ def choose_query_strategy(params):
     """
     Choose a query strategy based on the parameters.
 
+    :param params: Dictionary with the parameters.
+    :return: The chosen condition, or "Error" if the dates are invalid.
+    """
+    try:
+        return check_query_strategy(params)
+
+    except ValueError as e:
+        print("Error: Invalid date input. ", e)
+        return "Error"
+
+def check_query_strategy(params):
+    """
+    Choose a query strategy based on the parameters, raising on invalid dates.
+
     :param params: Dictionary with the parameters.
     :return: The chosen condition.
+    :raises ValueError: If the dates are malformed, out of range or too far apart.
     """
     bdate_str = params.get('bdate')
     edate_str = params.get('edate')
@@ -226,51 +280,47 @@ def choose_query_strategy(params):
     ## note condition 1 is NOT implemented in execute_query_strategy, 
     ## i.e. nothing special will happen if bdate and edate are missing, and reqeust happen once with parameters as is
 
-    try:
-        # Convert the strings to datetime objects
-        bdate = datetime.strptime(bdate_str, '%Y%m%d')
-        edate = datetime.strptime(edate_str, '%Y%m%d')
-
-        # Calculate the difference between the two dates
-        difference = edate - bdate
-        days_difference = difference.days
-
-        # Validate the dates
-        min_date = datetime.strptime('19800101', '%Y%m%d')
-        max_date = datetime.today()
-
-        if bdate < min_date or edate < min_date:
-            raise ValueError('Date cannot be before 1980-01-01.')
-        if bdate > max_date or edate > max_date:
-            raise ValueError('Date cannot be in the future.')
-        
-        if edate < bdate:
-            raise ValueError('End date cannot be before begin date.')
-
-        # Compare the difference to different periods
-        if days_difference <= 90:  # 3 months
-            return "condition 2"
-        elif days_difference <= 1825:  # 5 years
-            return "condition 3"
-        elif days_difference <= 3650:  # 10 years
-            print("Warning: Large date range may result in slower performance.")
-            return "condition 3"
-        else:
-            raise ValueError('Date range cannot be longer than 10 years.')
+    # Convert the strings to datetime objects
+    bdate = datetime.strptime(bdate_str, '%Y%m%d')
+    edate = datetime.strptime(edate_str, '%Y%m%d')
 
-    except ValueError as e:
-        print("Error: Invalid date input. ", e)
-        return "Error"
+    # Calculate the difference between the two dates
+    difference = edate - bdate
+    days_difference = difference.days
+
+    # Validate the dates
+    min_date = datetime.strptime('19800101', '%Y%m%d')
+    max_date = datetime.today()
+
+    if bdate < min_date or edate < min_date:
+        raise ValueError('Date cannot be before 1980-01-01.')
+    if bdate > max_date or edate > max_date:
+        raise ValueError('Date cannot be in the future.')
+    
+    if edate < bdate:
+        raise ValueError('End date cannot be before begin date.')
+
+    # Compare the difference to different periods
+    if days_difference <= 90:  # 3 months
+        return "condition 2"
+    elif days_difference <= 1825:  # 5 years
+        return "condition 3"
+    elif days_difference <= 3650:  # 10 years
+        logger.warning("Large date range may result in slower performance.")
+        return "condition 3"
+    else:
+        raise ValueError('Date range cannot be longer than 10 years.')
     
     
 
-def execute_query_strategy(goal, params):
+def execute_query_strategy(goal, params, cache=None):
     """
     Executes a query strategy based on the parameters.
 
     :param goal: The search goal.
     :param params: Dictionary with the parameters.
-    :return: The retrieved data as a pandas dataframe or None if an error occurred.
+    :param cache: A ResponseCache for the requests (optional).
+    :return: The retrieved data as a pandas dataframe; None if an error occurred or the data was streamed to a file.
     """
     strategy = choose_query_strategy(params)
     
@@ -283,21 +333,21 @@ def execute_query_strategy(goal, params):
         if answer == "No":
             return None
 
-        dataframe = chunk_query(goal, params)
-        return dataframe
-    
+        # the data is streamed to a file chosen by the user, nothing is kept in memory
+        chunk_query(goal, params, cache=cache)
+        return None
     
-    api_response = get_data(goal, params)
     
-    if api_response.status_code == 200:
-        data = api_response.json()
-        dataframe = convert_to_dataframe(data)
-        sg.popup("Data successfully retrieved.")
-        return dataframe
-    else:
+    client = AQSClient(params['email'], params['key'], cache=cache)
+    try:
+        dataframe = client.fetch(goal, params)
+    except AQSRequestError:
         sg.popup_error("Error retrieving data. Please check your input.")
         return None
 
+    sg.popup("Data successfully retrieved.")
+    return dataframe
+
 
 def save_data(dataframe):
     """
@@ -342,82 +392,356 @@ def divide_into_chunks(bdate, edate):
 
     return chunks
 
+### concurrent chunk fetching -- several chunk requests in flight, paced by a token bucket
+
+class RateLimiter:
+    '''
+    A thread-safe token bucket used to pace requests to the API.
+    Tokens refill continuously at `rate` per `per` seconds, up to `burst` tokens.
+    Each request takes one token; acquire() blocks until one is available.
+
+    The AQS API asks for no more than 10 requests per minute, hence the defaults.
+    '''
+    def __init__(self, rate=10, per=60.0, burst=1):
+        if rate <= 0 or per <= 0 or burst < 1:
+            raise ValueError("rate and per must be positive and burst at least 1.")
+        self.fill_rate = rate / per  # tokens per second
+        self.capacity = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Take one token, sleeping until the bucket has refilled enough if necessary.
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.fill_rate)
+                self.last_refill = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.fill_rate
+
+            time.sleep(wait)
+
+
+def _fetch_chunk(goal, chunk_params, rate_limiter, cache):
+    '''
+    Worker for fetch_chunks: request a single chunk, waiting for a token unless it is cached
+    '''
+    logger.info("Requesting %s between %s and %s", goal, chunk_params['bdate'], chunk_params['edate'])
+
+    return get_data(goal, chunk_params, cache, rate_limiter)
+
+def fetch_chunks(goal, params, chunks, max_workers=4, rate_limiter=None, cache=None):
+    """
+    Request every chunk of the date range with a bounded pool of worker threads.
+    Results are yielded in chunk order, whatever order the requests finish in.
+
+    :param goal: The search goal.
+    :param params: Dictionary with the parameters (bdate and edate are replaced per chunk).
+    :param chunks: A list of (bdate, edate) datetime tuples, see divide_into_chunks().
+    :param max_workers: The maximum number of requests in flight at once.
+    :param rate_limiter: A RateLimiter pacing the requests; a default one (10 per minute) is used if None.
+    :param cache: A ResponseCache; cached chunks are served without a request (optional).
+    :return: A generator of (chunk_params, response) tuples, in chunk order.
+    """
+    if rate_limiter is None:
+        rate_limiter = RateLimiter()
+
+    # keep at most two chunks per worker queued, so finished chunks waiting on a slow
+    # earlier one do not pile up in memory
+    window = max_workers * 2
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        chunk_iter = iter(chunks)
+
+        for chunk_bdate, chunk_edate in chunk_iter:
+            chunk_params = params.copy()
+            chunk_params['bdate'] = chunk_bdate.strftime('%Y%m%d')
+            chunk_params['edate'] = chunk_edate.strftime('%Y%m%d')
+            pending.append((chunk_params, executor.submit(_fetch_chunk, goal, chunk_params, rate_limiter, cache)))
+
+            if len(pending) >= window:
+                chunk_params, future = pending.popleft()
+                yield chunk_params, future.result()
+
+        while pending:
+            chunk_params, future = pending.popleft()
+            yield chunk_params, future.result()
+
+
+### checkpointing -- a JSON journal next to the output file records finished chunks
+
+class ChunkManifest:
+    '''
+    A small JSON journal recording which (goal, params, bdate, edate) chunks have been
+    written to an output file, so a restarted chunk_query skips them.
+
+    The journal lives next to the output file (e.g. "pm25.csv.manifest.json").
+    Credentials are never part of a chunk key.
+    '''
+    CREDENTIAL_KEYS = ("email", "key")
+
+    def __init__(self, output_file):
+        self.path = output_file + ".manifest.json"
+        self.entries = {"done": {}, "failed": {}}
+
+        if os.path.exists(self.path):
+            with open(self.path, "r") as file:
+                self.entries = json.load(file)
+
+    def chunk_key(self, goal, chunk_params):
+        '''
+        Build the key identifying a chunk: the goal plus its params without credentials
+        '''
+        params = {k: v for k, v in chunk_params.items() if k not in self.CREDENTIAL_KEYS}
+        return json.dumps([goal, params], sort_keys=True)
+
+    def is_done(self, key):
+        return key in self.entries["done"]
+
+    def has_progress(self):
+        return len(self.entries["done"]) > 0
+
+    def belongs_to(self, keys):
+        '''
+        Whether every chunk done is one of `keys`, i.e. the output only holds data of the request made of these chunks
+        '''
+        return set(self.entries["done"]) <= set(keys)
+
+    def reset(self):
+        '''
+        Forget every chunk, e.g. before the output file is started over for another request
+        '''
+        self.entries = {"done": {}, "failed": {}}
+        self.save()
+
+    def mark_done(self, keys):
+        '''
+        Record chunks as written to the output file and clear any earlier failure
+
+        :param keys: a list of chunk keys flushed together
+        '''
+        for key in keys:
+            self.entries["done"][key] = {"time": datetime.now().isoformat()}
+            self.entries["failed"].pop(key, None)
+        self.save()
+
+    def mark_failed(self, key, message):
+        self.entries["failed"][key] = {"message": message, "time": datetime.now().isoformat()}
+        self.save()
+
+    def save(self):
+        # write to a temporary file first so an interrupted save never corrupts the journal
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(self.entries, file, indent=2)
+        os.replace(temp_path, self.path)
+
+
+### programmatic API -- no GUI involved, usable from batch jobs and worker processes
+
+class AQSRequestError(Exception):
+    '''
+    Raised when the AQS API answers a request with an error
+    '''
+    def __init__(self, response):
+        try:
+            message = response.json().get('message', response.text)
+        except ValueError:
+            message = response.text
+        super().__init__(f"AQS request failed with status {response.status_code}: {message}")
+        self.status_code = response.status_code
+        self.message = message
+
+
+class AQSClient:
+    '''
+    GUI-free access to the AQS API: credentials, pacing, caching and progress are all passed in.
+    The GUI functions of this module (execute_query_strategy, chunk_query) are thin wrappers around it.
+
+    :param email: the email registered with the AQS API
+    :param api_key: the API key for that email
+    :param max_workers: the maximum number of chunk requests in flight at once
+    :param rate_limiter: a RateLimiter shared by all requests of this client (default: 10 requests per minute)
+    :param cache: a ResponseCache (optional)
+    :param progress: a callback progress(done, total, chunk_params, error) called after every chunk of a bulk download (optional)
+    '''
+    def __init__(self, email, api_key, max_workers=4, rate_limiter=None, cache=None, progress=None):
+        self.email = email
+        self.api_key = api_key
+        self.max_workers = max_workers
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.cache = cache
+        self.progress = progress
+
+    @classmethod
+    def from_key_file(cls, file_name="aqsEmailKey.txt", **kwargs):
+        '''
+        Create a client from a key file (email on the first line, api key on the second)
+        '''
+        email, api_key = read_api_key(file_name)
+        return cls(email, api_key, **kwargs)
+
+    def params(self, goal, input_values=None):
+        '''
+        Complete the parameters of a goal with the client's credentials (see complete_params)
+
+        :param input_values: a dictionary holding a value for every parameter the goal requires
+        '''
+        params = {"email": self.email, "key": self.api_key}
+
+        if input_values is not None:
+            for parameter in get_params(goal):
+                params[parameter] = input_values[parameter]
+
+        return params
+
+    def _with_credentials(self, params):
+        params = dict(params)
+        params["email"] = self.email
+        params["key"] = self.api_key
+        return params
+
+    def get_data(self, goal, params):
+        '''
+        Send a single request and return the response (see get_data)
+        '''
+        return get_data(goal, self._with_credentials(params), self.cache, self.rate_limiter)
+
+    def fetch(self, goal, params):
+        '''
+        Send a single request and return its data as a pandas DataFrame
+
+        :raises AQSRequestError: if the API answers with an error
+        '''
+        api_response = self.get_data(goal, params)
+        if api_response.status_code != 200:
+            raise AQSRequestError(api_response)
+        return convert_to_dataframe(api_response.json())
+
+    def bulk_download(self, goal, params, sink):
+        '''
+        Download a long date range in quarter-year chunks, streaming every chunk into a sink.
+
+        Chunks are requested concurrently and written in chunk order. Finished chunks are journaled
+        in a ChunkManifest next to the sink's output, so running the same download again only
+        requests the chunks that failed or are missing. A different download into the same output
+        starts it over. A failed chunk does not stop the others.
+
+        :param params: the parameters, with 'bdate' and 'edate' in the format 'yyyymmdd'
+        :param sink: a CSVSink, ParquetSink or SQLiteSink (see data_sinks.py)
+        :return: the sink summary (format, path, rows, chunks) plus the list of failed chunks
+        '''
+        params = self._with_credentials(params)
+        bdate = datetime.strptime(params['bdate'], '%Y%m%d')
+        edate = datetime.strptime(params['edate'], '%Y%m%d')
+        chunks = divide_into_chunks(bdate, edate)
+
+        manifest = ChunkManifest(sink.path)
+
+        keys = []
+        for chunk_bdate, chunk_edate in chunks:
+            chunk_params = params.copy()
+            chunk_params['bdate'] = chunk_bdate.strftime('%Y%m%d')
+            chunk_params['edate'] = chunk_edate.strftime('%Y%m%d')
+            keys.append(manifest.chunk_key(goal, chunk_params))
+
+        # an output written by another request (other goal, params or dates) is started over, never appended to
+        if not manifest.belongs_to(keys):
+            logger.info("%s holds data of another request, starting it over", sink.path)
+            manifest.reset()
+
+        # skip the chunks a previous run already wrote
+        remaining = [chunk for chunk, key in zip(chunks, keys) if not manifest.is_done(key)]
+
+        if len(remaining) < len(chunks):
+            logger.info("Resuming: %d of %d chunks already downloaded", len(chunks) - len(remaining), len(chunks))
+
+        # a fresh download starts the output over instead of appending to old data
+        sink.open(resume=manifest.has_progress())
+        errors = []
+
+        try:
+            chunk_results = fetch_chunks(goal, params, remaining, self.max_workers, self.rate_limiter, self.cache)
+            for done, (chunk_params, api_response) in enumerate(chunk_results, start=1):
+                key = manifest.chunk_key(goal, chunk_params)
+                error = None
+
+                if api_response.status_code == 200:
+                    sink.write(api_response.json()['Data'])
+                    manifest.mark_done([key])
+                else:
+                    # keep going with the other chunks; a rerun will retry this one
+                    error = AQSRequestError(api_response).message
+                    manifest.mark_failed(key, str(error))
+                    errors.append(f"{chunk_params['bdate']}-{chunk_params['edate']}: {error}")
+                    logger.warning("Chunk %s-%s failed: %s", chunk_params['bdate'], chunk_params['edate'], error)
+
+                if self.progress is not None:
+                    self.progress(done, len(remaining), chunk_params, error)
+        finally:
+            summary = sink.close()
+
+        summary['failed'] = errors
+        return summary
+
+    def query(self, goal, params, sink=None):
+        '''
+        Pick the strategy from the date range, like execute_query_strategy does for the GUI:
+        up to 3 months is a single request returning a DataFrame; longer ranges need a sink
+        and return the bulk_download summary.
+
+        :raises ValueError: if the dates are invalid, or a long range is requested without a sink
+        :raises AQSRequestError: if a single request fails
+        '''
+        if check_query_strategy(params) == "condition 3":
+            if sink is None:
+                raise ValueError("Requests longer than 3 months are streamed, please provide a sink.")
+            return self.bulk_download(goal, params, sink)
+
+        return self.fetch(goal, params)
+
+
 ## key query function
-def chunk_query(goal, params):
+def chunk_query(goal, params, sink=None, max_workers=4, rate_limiter=None, cache=None):
     """
-    Query the API in chunks. 
-    Handle the case into chunk and store directly when request range exceeds 3 months.
-    Ohterwise, store the data into a dataframe and return it.
+    Query the API in chunks and stream every chunk straight into a sink (see data_sinks.py).
+    Used when the request range exceeds 3 months; the GUI side of AQSClient.bulk_download.
+
+    Choosing the same file again resumes the download, only requesting chunks that failed or are missing.
 
     :param goal: The search goal.
     :param params: Dictionary with the parameters.
-    :return: The retrieved data as a pandas dataframe; or return nothing but create a large .csv file when data range is large.
+    :param sink: A CSVSink, ParquetSink or SQLiteSink; if None, the user picks a file and the sink follows its extension.
+    :param max_workers: The maximum number of chunk requests in flight at once.
+    :param rate_limiter: A RateLimiter pacing the requests (default: 10 requests per minute).
+    :param cache: A ResponseCache serving previously downloaded chunks from disk (optional).
+    :return: The sink summary (format, path, rows, chunks) plus the list of failed chunks; None if cancelled.
     """
+    if sink is None:
+        # user can choose where to save the file and give it a name
+        file_name = sg.popup_get_file("Create a file", save_as=True, default_extension=".csv")
+        if not file_name:
+            return None
+        sink = data_sinks.sink_for_file(file_name)
 
-    bdate = datetime.strptime(params['bdate'], '%Y%m%d')
-    edate = datetime.strptime(params['edate'], '%Y%m%d')
-    chunks = divide_into_chunks(bdate, edate)
-
-    dataframe = None
-
-    # Define a threshold for number of rows
-    # when exceeded, write the dataframe to disk and clear it
-    THRESHOLD = 10000
-    # user can choose where to save the file and give it a name
-    file_name = sg.popup_get_file("Create a file", save_as=True, default_extension=".csv")
-
-    for chunk_bdate, chunk_edate in chunks:
-        chunk_params = params.copy()
-        chunk_params['bdate'] = chunk_bdate.strftime('%Y%m%d')
-        chunk_params['edate'] = chunk_edate.strftime('%Y%m%d')
-        
-        print('Now requesting: ', goal)
-        print('Between datetime: ', chunk_params['bdate'], chunk_params['edate'])
-        
-
-        api_response = get_data(goal, chunk_params)
-        if api_response.status_code == 200:
-            data = api_response.json()
-            chunk_dataframe = convert_to_dataframe(data)
-
-
-            if dataframe is None:
-                dataframe = chunk_dataframe
-            else:
-                dataframe = pd.concat([dataframe, chunk_dataframe], ignore_index=True)
-
-            # When dataframe size reaches THRESHOLD, write it to disk
-            if len(dataframe) >= THRESHOLD:
-                # Write the dataframe to a CSV file
-                # If the file doesn't exist, create it and write with header
-                # If the file exists, append to it without writing the header
-                with open(file_name, 'a') as f:
-                    dataframe.to_csv(f, header=f.tell()==0, index=False)
-                    
-                # Clear the dataframe
-                dataframe = pd.DataFrame()
-                
-
-            # if dataframe is None:
-            #     dataframe = chunk_dataframe
-            # else:
-            #     dataframe = pd.concat([dataframe, chunk_dataframe], ignore_index=True)
-            print("resting...")
-            time.sleep(5)
-        else:
-            try:
-                error_data = api_response.json()
-                error_message = error_data.get('message', api_response.text)
-            except ValueError:
-                error_message = api_response.text
-            sg.popup_error(f"Error retrieving data. Message: {error_message}")
-            if dataframe is None:
-                return None
-            else:
-                return dataframe
-        
-
-    sg.popup("Data successfully retrieved.")
-    return dataframe
+    def show_progress(done, total, chunk_params, error):
+        print(f"Chunk {done} of {total} ({chunk_params['bdate']} - {chunk_params['edate']})", "failed" if error else "done")
 
+    client = AQSClient(params['email'], params['key'], max_workers, rate_limiter, cache, show_progress)
+    summary = client.bulk_download(goal, params, sink)
+    errors = summary['failed']
 
+    if errors:
+        sg.popup_error(f"Error retrieving {len(errors)} chunks. "
+                       "Run the same request with the same file to retry them.\n" + "\n".join(errors))
+    else:
+        sg.popup(f"Data successfully retrieved: {summary['rows']} rows saved to {summary['path']}")
+    return summary
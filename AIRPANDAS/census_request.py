@@ -1,7 +1,12 @@
 import requests
+import requests.adapters
 import json
+import time
 import pandas as pd
 import PySimpleGUI as sg
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from response_cache import ResponseCache
 
 
 def get_api_key(file_name = "censusapikey.txt"):
@@ -52,66 +57,257 @@ def read_json(filename):
     
 
 
-def query_census_data(start_year, end_year, category):
+census_url = "https://api.census.gov/data/{year}/acs/acs5/profile"
+
+## the API returns at most 50 variables per call, NAME included
+max_census_variables = 50
+
+
+def normalize_states(states):
     '''
-    Query the US Census API for data in the specified category for the specified years
-    Store the output as a CSV file
+    Turn the states argument into a list of two-digit state FIPS codes
+
+    :param states: a state FIPS code, a list of them, or "*" / "all" for every state
+    :return: a list of codes; ["*"] means all states in a single call (in=state:*)
+    '''
+    if isinstance(states, (str, int)):
+        states = [states]
+
+    states = [str(state) for state in states]
+    if any(state in ("*", "all") for state in states):
+        return ["*"]
 
+    return sorted({state.zfill(2) for state in states})
+
+
+def plan_census_requests(categories, start_year, end_year, year_category_abbrev_dict):
+    '''
+    List every (category, year) pair to request up front, skipping pairs with no data
+
+    :param categories: the categories to query (e.g. ['RACE', 'INCOME_AND_BENEFITS'])
     :param start_year: the first year to query
     :param end_year: the last year to query (inclusive)
-    :param category: the category to query (e.g. 'race')
+    :param year_category_abbrev_dict: the year -> category -> abbreviations mapping (year_category_abbrev.json)
+    :return: a list of (category, year) tuples, year as a string
     '''
+    plan = []
+    for category in categories:
+        for year in range(start_year, end_year + 1):
+            year = str(year) # Convert year to string to use as a dictionary key
 
-    # Load the JSON mappings
-    category_code_dict = read_json('AIRPANDAS\json\category_code.json')
-    year_category_abbrev_dict = read_json('AIRPANDAS\json\year_category_abbrev.json')
+            # Ensure the category exists for the year
+            if year not in year_category_abbrev_dict or category not in year_category_abbrev_dict[year]:
+                print(f'No data for category "{category}" in year {year}')
+                continue
 
-    df = pd.DataFrame()
-    data = []
+            plan.append((category, year))
 
-    # Query the data for each year
-    for year in range(start_year, end_year + 1):
-        year = str(year) # Convert year to string to use as a dictionary key
+    return plan
 
-        # Ensure the category exists for the year
-        if year not in year_category_abbrev_dict or category not in year_category_abbrev_dict[year]:
-            print(f'No data for category "{category}" in year {year}')
-            continue
 
-        # Get the list of codes for the category in the year
-        codes = category_code_dict[category][year]
+def request_census(session, year, params, retries=3, backoff=1.0, cache=None):
+    '''
+    Send one request to the ACS5 profile endpoint, retrying with exponential backoff
+    on connection errors, rate limiting (429) and server errors (5xx)
+
+    :param session: the requests.Session to send the request with
+    :param year: the ACS5 year, as a string
+    :param params: the request parameters, including the api key
+    :param retries: how many times to retry a failed request
+    :param backoff: seconds to wait before the first retry, doubled on each retry
+    :param cache: a ResponseCache to serve repeated requests from disk (optional)
+    :return: the parsed JSON rows (the first row is the header), or None if the request failed
+    '''
+    url = census_url.format(year=year)
+
+    # a released ACS5 year never changes, so it is cached for good
+    response = cache.get(url, params) if cache is not None else None
+
+    attempt = 0
+    while response is None:
+        try:
+            response = session.get(url, params=params, timeout=60)
+        except requests.RequestException as e:
+            response = None
+            error = str(e)
+        else:
+            error = f'status code {response.status_code}'
+            if response.status_code == 429 or response.status_code >= 500:
+                response = None
+
+        if response is None:
+            if attempt >= retries:
+                print(f'Request failed for year {year} with {error}')
+                return None
+            time.sleep(backoff * 2 ** attempt)
+            attempt += 1
+        elif cache is not None:
+            cache.put(url, params, response, ttl=cache.ttl_for(datetime(int(year), 12, 31)))
+
+    # Check for a successful response
+    if response.status_code != 200:
+        print(f'Request failed for year {year} with status code {response.status_code}')
+        return None
+
+    return response.json() # parse once
+
+def plan_merged_requests(plan, category_code_dict, max_variables=max_census_variables, states=("06",)):
+    '''
+    Pack the codes of several categories of the same year into as few requests as the
+    API's per-call variable limit allows (NAME counts as one of the variables).
+    Each request is repeated for every state that needs a separate call.
+
+    :param plan: a list of (category, year) tuples, see plan_census_requests()
+    :param category_code_dict: the category -> year -> codes mapping (category_code.json)
+    :param max_variables: the maximum number of variables per request
+    :param states: the states to query, see normalize_states()
+    :return: a list of (year, state, codes) tuples, one per request
+    '''
+    codes_per_request = max_variables - 1
 
-        # Construct the URL for the API request
-        url = f"https://api.census.gov/data/{year}/acs/acs5/profile?get=NAME,{','.join(codes)}&for=county:*&in=state:06&key={get_api_key()}"
+    # every code needed per year, once, in plan order
+    year_codes = {}
+    for category, year in plan:
+        codes = year_codes.setdefault(year, [])
+        codes.extend(code for code in category_code_dict[category][year] if code not in codes)
 
-        # Send the API request and get the response
-        response = requests.get(url)
-        print("Querying data for year", year)
+    requests_plan = []
+    for year, codes in year_codes.items():
+        for state in normalize_states(states):
+            for i in range(0, len(codes), codes_per_request):
+                requests_plan.append((year, state, codes[i:i + codes_per_request]))
 
-        # Check for a successful response
-        if response.status_code != 200:
-            print(f'Request failed for year {year} with status code {response.status_code}')
-            continue
+    return requests_plan
 
-        # Parse the response JSON into a DataFrame, assuming the first row is the header
-        year_df = pd.DataFrame(response.json()[1:], columns=response.json()[0])
+def fetch_census_codes(session, api_key, year, state, codes, retries=3, backoff=1.0, cache=None):
+    '''
+    Query a list of variable codes in one year, for every county of a state ("*" for all states)
 
-        year_df['Year'] = year  # Add a column for the year
+    :return: a DataFrame with NAME, the codes, state and county as columns; None if the request failed
+    '''
+    params = {"get": f"NAME,{','.join(codes)}", "for": "county:*", "in": f"state:{state}", "key": api_key}
+
+    print("Querying", len(codes), "variables for year", year, "in state", state)
+    rows = request_census(session, year, params, retries, backoff, cache)
+    if rows is None:
+        return None
+
+    # Build the DataFrame, assuming the first row is the header
+    return pd.DataFrame(rows[1:], columns=rows[0])
+
+def split_census_response(year_df, year, categories, category_code_dict, year_category_abbrev_dict):
+    '''
+    Split the combined response of one year back into one table per category,
+    with the abbreviated column names from year_category_abbrev.json
+
+    :param year_df: all the variables retrieved for the year (see fetch_census_codes), for one or more states
+    :return: a dictionary of category -> DataFrame; categories missing some of their codes are left out
+    '''
+    tables = {}
+    for category in categories:
+        # Get the list of codes for the category in the year
+        codes = category_code_dict[category][year]
+        if any(code not in year_df.columns for code in codes):
+            print(f'Missing data for category "{category}" in year {year}')
+            continue
+
+        category_df = year_df[['NAME'] + codes + ['state', 'county']].copy()
+        category_df['Year'] = year  # Add a column for the year
+        category_df['FIPS'] = category_df['state'] + category_df['county']
 
         # Replace the column names with their abbreviations
         abbrevs = year_category_abbrev_dict[year][category]
-        for code, abbrev in zip(codes, abbrevs):
-            year_df.rename(columns={code: abbrev}, inplace=True)
+        tables[category] = category_df.rename(columns=dict(zip(codes, abbrevs)))
 
-        data.append(year_df)
+    return tables
 
-    # Concatenate the data for all years into a single DataFrame
-    df = pd.concat(data, ignore_index=True)
+def download_census_batch(plan, api_key=None, max_workers=8, retries=3, backoff=1.0, cache=None, max_variables=max_census_variables, states=("06",)):
+    '''
+    Download every (category, year) pair of a plan on a bounded pool of worker threads,
+    sharing one requests.Session (and its connection pool) between them.
+
+    The codes of all categories of a year are merged into as few requests as the variable limit
+    allows (see plan_merged_requests), then split back into per-category tables.
+    States needing separate calls are requested concurrently and stacked into one FIPS-keyed table.
+
+    :param plan: a list of (category, year) tuples, see plan_census_requests()
+    :param api_key: the census api key; read with get_api_key() if None
+    :param max_workers: the maximum number of requests in flight at once
+    :param retries: how many times to retry a failed request
+    :param backoff: seconds to wait before the first retry, doubled on each retry
+    :param cache: a ResponseCache to serve repeated requests from disk (optional)
+    :param max_variables: the maximum number of variables per request
+    :param states: a state FIPS code, a list of them, or "*" for all states (default: California)
+    :return: a dictionary of category -> DataFrame with all its years and states, in year order
+    '''
+    if api_key is None:
+        api_key = get_api_key()
+
+    # Load the JSON mappings
+    category_code_dict = read_json('AIRPANDAS\json\category_code.json')
+    year_category_abbrev_dict = read_json('AIRPANDAS\json\year_category_abbrev.json')
+
+    requests_plan = plan_merged_requests(plan, category_code_dict, max_variables, states)
+    print(f"{len(plan)} category-years merged into {len(requests_plan)} requests")
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount("https://", adapter)
+
+    with session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch_census_codes, session, api_key, year, state, codes, retries, backoff, cache)
+                   for year, state, codes in requests_plan]
+
+        # join the requests of each year and state side by side, on the county
+        year_frames = {}
+        for (year, state, codes), future in zip(requests_plan, futures):
+            codes_df = future.result()
+            if codes_df is None:
+                continue
+            if (year, state) not in year_frames:
+                year_frames[(year, state)] = codes_df
+            else:
+                year_frames[(year, state)] = year_frames[(year, state)].merge(codes_df.drop(columns='NAME'), on=['state', 'county'])
+
+    year_categories = {}
+    for category, year in plan:
+        year_categories.setdefault(year, []).append(category)
+
+    data = {}
+    for year, categories in sorted(year_categories.items()):
+        for state in normalize_states(states):
+            if (year, state) not in year_frames:
+                continue
+            tables = split_census_response(year_frames[(year, state)], year, categories, category_code_dict, year_category_abbrev_dict)
+            for category, category_df in tables.items():
+                data.setdefault(category, []).append(category_df)
+
+    # Concatenate the data for all years into a single DataFrame per category
+    return {category: pd.concat(frames, ignore_index=True) for category, frames in data.items()}
+
+
+def query_census_data(start_year, end_year, category, cache=None, states=("06",)):
+    '''
+    Query the US Census API for data in the specified category for the specified years
+    Store the output as a CSV file
+
+    :param start_year: the first year to query
+    :param end_year: the last year to query (inclusive)
+    :param category: the category to query (e.g. 'race')
+    :param cache: a ResponseCache to serve repeated requests from disk (optional)
+    :param states: a state FIPS code, a list of them, or "*" for all states (default: California)
+    '''
+    year_category_abbrev_dict = read_json('AIRPANDAS\json\year_category_abbrev.json')
+    plan = plan_census_requests([category], start_year, end_year, year_category_abbrev_dict)
+
+    data = download_census_batch(plan, cache=cache, states=states)
+    if category not in data:
+        raise ValueError(f'No data retrieved for category "{category}" between {start_year} and {end_year}')
 
     print("Saving data to CSV file")
 
     # Save the DataFrame to a CSV file
-    df.to_csv(f'census_data_{category}_{start_year}-{end_year}.csv', index=False)
+    data[category].to_csv(f'census_data_{category}_{start_year}-{end_year}.csv', index=False)
 
 
 
@@ -122,7 +318,10 @@ def main():
     This is an example of how to use the functions in this file to query the US Census API
     Query the US Census API for data in each category for the years 2009 to 2021
     Store the output for each category as a separate CSV file
+
+    All (category, year) requests are planned up front and downloaded concurrently.
     '''
+    cache = ResponseCache()
     
     # Load the year-category-abbrev mapping
     year_category_abbrev_dict = read_json('AIRPANDAS\json\year_category_abbrev.json')
@@ -133,9 +332,14 @@ def main():
         categories.update(year_category_abbrev_dict[year].keys())
 
     # Query data for each category
-    for category in categories:
-        print(f'Querying data for category "{category}"')
-        query_census_data(2009, 2021, category)
+    plan = plan_census_requests(sorted(categories), 2009, 2021, year_category_abbrev_dict)
+    data = download_census_batch(plan, cache=cache)
+
+    for category, df in data.items():
+        print(f'Saving data for category "{category}"')
+        df.to_csv(f'census_data_{category}_2009-2021.csv', index=False)
+
+    print("Response cache:", cache.stats())
 
 if __name__ == "__main__":
     main()
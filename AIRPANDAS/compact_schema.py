@@ -0,0 +1,350 @@
+import sqlite3
+import pandas as pd
+import data_cleaning
+
+'''
+A compact, typed storage layout for the AQS sample data
+
+The wide PM25 table repeats the site, county and parameter descriptions (and the FIPS code and
+dates as text) on every hourly row. The compact layout stores them once, in dimension tables:
+
+    aqs_counties   (fips, state_code, county_code, state, county)
+    aqs_sites      (site_id, fips, site_number, latitude, longitude, datum, cbsa_code)
+    aqs_parameters (parameter_code, parameter, units_of_measure, units_of_measure_code)
+
+and keeps a narrow fact table of integers and reals, "PM25_fact":
+
+    site_id, parameter_code, poc, fips, year, epoch_day (days since 1970-01-01, local date),
+    minute (of the local day), gmt_shift (minutes from local to GMT), sample_measurement,
+    last_change (epoch day of date_of_last_change)
+
+A view named like the wide table ("PM25") joins them back with the original column names and
+values (FIPS as '06037', date_local as '2020-01-01 00:00:00.000000', ...), so every query of the
+project keeps working. The view also exposes the raw fips_code and epoch_day columns; the
+QueryBuilder in database_query.py filters on those so SQLite can use the fact table indexes.
+
+Ids are derived from the AQS codes (site_id = state, county and site number digits), so chunks
+can be processed on worker processes without a shared id lookup.
+
+A measurement is identified by its natural key (site, parameter, poc, local date and time), a unique
+index on the fact table: loading a measurement again updates it instead of duplicating it, so
+upsert_aqs_compact() can refresh the database with new files only (see data_cleaning.load_ledger).
+'''
+
+dimension_tables = {
+    "aqs_counties": """
+        CREATE TABLE IF NOT EXISTS aqs_counties (
+            fips INTEGER PRIMARY KEY,
+            state_code INTEGER,
+            county_code INTEGER,
+            state TEXT,
+            county TEXT
+        )""",
+    "aqs_sites": """
+        CREATE TABLE IF NOT EXISTS aqs_sites (
+            site_id INTEGER PRIMARY KEY,
+            fips INTEGER,
+            site_number INTEGER,
+            latitude REAL,
+            longitude REAL,
+            datum TEXT,
+            cbsa_code INTEGER
+        )""",
+    "aqs_parameters": """
+        CREATE TABLE IF NOT EXISTS aqs_parameters (
+            parameter_code INTEGER PRIMARY KEY,
+            parameter TEXT,
+            units_of_measure TEXT,
+            units_of_measure_code INTEGER
+        )""",
+}
+
+fact_columns = ["site_id", "parameter_code", "poc", "fips", "year", "epoch_day", "minute", "gmt_shift",
+                "sample_measurement", "last_change"]
+
+natural_key = ["site_id", "parameter_code", "poc", "epoch_day", "minute"]
+
+## dimension table columns, in the order of their CREATE TABLE
+dimension_columns = {
+    "aqs_counties": ["fips", "state_code", "county_code", "state", "county"],
+    "aqs_sites": ["site_id", "fips", "site_number", "latitude", "longitude", "datum", "cbsa_code"],
+    "aqs_parameters": ["parameter_code", "parameter", "units_of_measure", "units_of_measure_code"],
+}
+
+
+def fact_table_name(table_name):
+    return f"{table_name}_fact"
+
+def fact_table_sql(table_name):
+    return f"""
+        CREATE TABLE IF NOT EXISTS "{fact_table_name(table_name)}" (
+            site_id INTEGER NOT NULL,
+            parameter_code INTEGER NOT NULL,
+            poc INTEGER,
+            fips INTEGER NOT NULL,
+            year INTEGER NOT NULL,
+            epoch_day INTEGER NOT NULL,
+            minute INTEGER NOT NULL,
+            gmt_shift INTEGER,
+            sample_measurement REAL,
+            last_change INTEGER
+        )"""
+
+def natural_key_index_name(table_name):
+    return f"ux_{fact_table_name(table_name)}_natural_key"
+
+def natural_key_index_sql(table_name):
+    return f'CREATE UNIQUE INDEX IF NOT EXISTS "{natural_key_index_name(table_name)}" ON "{fact_table_name(table_name)}" ({", ".join(natural_key)})'
+
+def fact_upsert_sql(table_name):
+    '''
+    Insert a fact row, or update the measurement already stored under its natural key
+    '''
+    updates = ", ".join(f"{column} = excluded.{column}" for column in fact_columns if column not in natural_key)
+    return f'''INSERT INTO "{fact_table_name(table_name)}" ({", ".join(fact_columns)})
+               VALUES ({", ".join("?" for _ in fact_columns)})
+               ON CONFLICT ({", ".join(natural_key)}) DO UPDATE SET {updates}'''
+
+def view_sql(table_name):
+    '''
+    The compatibility view: the columns of the wide table, in the same order, then the raw keys
+    (LEFT JOINs on the dimension keys, so SQLite skips the dimensions a query does not read)
+    '''
+    gmt_seconds = "(f.epoch_day * 1440 + f.minute + f.gmt_shift) * 60"
+    return f"""
+        CREATE VIEW IF NOT EXISTS "{table_name}" AS
+        SELECT c.state_code, c.county_code, f.parameter_code, s.latitude, s.longitude, s.datum, p.parameter,
+               date(f.epoch_day * 86400, 'unixepoch') || ' 00:00:00.000000' AS date_local,
+               printf('%02d:%02d', f.minute / 60, f.minute % 60) AS time_local,
+               date({gmt_seconds}, 'unixepoch') AS date_gmt,
+               strftime('%H:%M', {gmt_seconds}, 'unixepoch') AS time_gmt,
+               f.sample_measurement, p.units_of_measure, p.units_of_measure_code, c.state, c.county,
+               date(f.last_change * 86400, 'unixepoch') AS date_of_last_change, s.cbsa_code,
+               printf('%05d', f.fips) AS FIPS, f.year,
+               CAST(strftime('%m', f.epoch_day * 86400, 'unixepoch') AS INTEGER) AS month,
+               CAST(strftime('%d', f.epoch_day * 86400, 'unixepoch') AS INTEGER) AS day,
+               f.fips AS fips_code, f.epoch_day, f.site_id, f.poc
+        FROM "{fact_table_name(table_name)}" f
+        LEFT JOIN aqs_sites s ON s.site_id = f.site_id
+        LEFT JOIN aqs_counties c ON c.fips = f.fips
+        LEFT JOIN aqs_parameters p ON p.parameter_code = f.parameter_code"""
+
+
+def compact_aqs_chunk(chunk):
+    '''
+    Process a raw chunk of AQS sample data (read with data_cleaning.aqs_dtypes) into the compact layout
+
+    :param chunk: a chunk of data from the AQS API sampleData (pandas DataFrame)
+    :return: a {table: DataFrame} dictionary, "fact" for the fact table rows and one entry per
+             dimension table with the distinct rows of the chunk
+    '''
+    # same rows as process_aqs_chunk: only the measurements without a qualifier
+    chunk = chunk[chunk['qualifier'].isnull()]
+
+    epoch = pd.Timestamp('1970-01-01')
+    local_day = pd.to_datetime(chunk['date_local'], format='%Y-%m-%d')
+    local_time = pd.to_timedelta(chunk['time_local'] + ':00')
+    gmt = pd.to_datetime(chunk['date_gmt'] + ' ' + chunk['time_gmt'], format='%Y-%m-%d %H:%M')
+    last_change = pd.to_datetime(chunk['date_of_last_change'], format='%Y-%m-%d')
+
+    fips = chunk['state_code'] * 1000 + chunk['county_code']
+    site_id = fips * 10000 + chunk['site_number']
+
+    fact = pd.DataFrame({
+        'site_id': site_id,
+        'parameter_code': chunk['parameter_code'],
+        'poc': chunk['poc'],
+        'fips': fips,
+        'year': local_day.dt.year,
+        'epoch_day': (local_day - epoch).dt.days,
+        'minute': (local_time.dt.total_seconds() // 60).astype('Int64'),
+        'gmt_shift': ((gmt - (local_day + local_time)).dt.total_seconds() // 60).astype('Int64'),
+        'sample_measurement': chunk['sample_measurement'],
+        'last_change': (last_change - epoch).dt.days.astype('Int64'),
+    })
+
+    counties = pd.DataFrame({'fips': fips, 'state_code': chunk['state_code'], 'county_code': chunk['county_code'],
+                             'state': chunk['state'], 'county': chunk['county']})
+    sites = pd.DataFrame({'site_id': site_id, 'fips': fips, 'site_number': chunk['site_number'],
+                          'latitude': chunk['latitude'], 'longitude': chunk['longitude'],
+                          'datum': chunk['datum'], 'cbsa_code': chunk['cbsa_code']})
+    parameters = chunk[dimension_columns['aqs_parameters']]
+
+    return {
+        'fact': fact,
+        'aqs_counties': counties.drop_duplicates('fips'),
+        'aqs_sites': sites.drop_duplicates('site_id'),
+        'aqs_parameters': parameters.drop_duplicates('parameter_code'),
+    }
+
+
+def create_compact_tables(conn, table_name, replace=True):
+    '''
+    Create the dimension tables, the fact table and the view (replacing a wide table of the same name)
+    '''
+    if replace:
+        conn.execute(f'DROP VIEW IF EXISTS "{table_name}"')
+        conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+        conn.execute(f'DROP TABLE IF EXISTS "{fact_table_name(table_name)}"')
+    elif conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table_name,)).fetchone():
+        raise ValueError(f"{table_name} is a wide table, load it with if_exists='replace' to convert it")
+
+    for sql in dimension_tables.values():
+        conn.execute(sql)
+    conn.execute(fact_table_sql(table_name))
+    conn.execute(natural_key_index_sql(table_name))
+    conn.execute(view_sql(table_name))
+
+def write_compact_chunk(conn, chunk, table_name):
+    '''
+    Write one compact chunk: replace its dimension rows (the latest description wins), upsert its facts
+    '''
+    for dimension, columns in dimension_columns.items():
+        conn.executemany(f'INSERT OR REPLACE INTO {dimension} ({", ".join(columns)}) VALUES ({", ".join("?" for _ in columns)})',
+                         data_cleaning.prepare_rows(chunk[dimension][columns]))
+
+    conn.executemany(fact_upsert_sql(table_name), data_cleaning.prepare_rows(chunk['fact'][fact_columns]))
+
+def insert_compact_chunks(chunks, sql_database, table_name='PM25', if_exists='replace'):
+    '''
+    Write compact chunks (see compact_aqs_chunk) into the database, the way data_cleaning.bulk_insert_chunks
+    writes wide ones: one transaction, fact table indexes dropped during the load and rebuilt at the end
+    (except the natural key index, which the upserts need). The rollups of the table, if any, are then recomputed.
+
+    :param chunks: an iterable of compact chunks
+    :param sql_database: the name of the SQLite database file
+    :param table_name: the name of the view, the fact table is named after it
+    :param if_exists: 'replace' the data, or 'append' to it (upserting on the natural key)
+    :return: the number of rows loaded
+    '''
+    conn = sqlite3.connect(sql_database, isolation_level=None) # transactions are managed by hand
+    data_cleaning.bulk_load_pragmas(conn)
+
+    indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL AND name != ?",
+                           (fact_table_name(table_name), natural_key_index_name(table_name))).fetchall()
+
+    rows_loaded = 0
+    first_day = last_day = None
+    conn.execute("BEGIN")
+    try:
+        for name, _ in indexes:
+            conn.execute(f'DROP INDEX IF EXISTS "{name}"')
+        create_compact_tables(conn, table_name, replace=(if_exists == 'replace'))
+
+        for chunk in chunks:
+            write_compact_chunk(conn, chunk, table_name)
+            rows_loaded += len(chunk['fact'])
+            days = chunk['fact']['epoch_day']
+            if len(days):
+                first_day = days.min() if first_day is None else min(first_day, days.min())
+                last_day = days.max() if last_day is None else max(last_day, days.max())
+
+        print('Rebuilding indexes')
+        for name, sql in indexes:
+            conn.execute(sql)
+
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+    # recompute the rollups of the table, if any: all of them after a replace, the dates loaded after an append
+    import rollups # imported here: the worker processes import this module, they do not need the query modules
+    if if_exists == 'replace':
+        rollups.refresh_after_load(sql_database, table_name)
+    elif first_day is not None:
+        rollups.refresh_after_load(sql_database, table_name, epoch_day_to_date(first_day), epoch_day_to_date(last_day))
+
+    return rows_loaded
+
+def compact_chunks(file_names, chunk_size, workers=None):
+    '''
+    The compact chunks of the files, processed on worker processes (or in this process if workers is 1)
+    '''
+    if workers == 1:
+        return data_cleaning.read_aqs_chunks(file_names, chunk_size, process=compact_aqs_chunk)
+    return data_cleaning.parallel_aqs_chunks(file_names, chunk_size, workers, process=compact_aqs_chunk)
+
+def epoch_day_to_date(day):
+    return str((pd.Timestamp('1970-01-01') + pd.Timedelta(days=int(day))).date())
+
+def load_aqs_compact(file_names, chunk_size, sql_database, table_name='PM25', if_exists='replace', workers=None):
+    '''
+    Load a list of AQS sample CSV files into the compact layout, processing the chunks on worker processes
+    (see data_cleaning.parallel_load_aqs_csv). Call it under `if __name__ == '__main__':`.
+
+    :param file_names: a *list* of CSV file names to process
+    :param chunk_size: the number of rows per block
+    :param sql_database: the name of the SQLite database file
+    :param table_name: the name of the view, the fact table is named after it
+    :param if_exists: 'replace' the data, or 'append' to it (upserting on the natural key)
+    :param workers: the number of worker processes (default: the number of cores), 1 to process in this process
+    :return: the number of rows loaded
+    '''
+    return insert_compact_chunks(compact_chunks(file_names, chunk_size, workers), sql_database, table_name, if_exists)
+
+def upsert_aqs_compact(file_names, chunk_size, sql_database, table_name='PM25', workers=None, force=False):
+    '''
+    Incremental load: upsert the files not loaded yet (or changed since) into the compact layout,
+    keeping the existing data. Each file is one transaction, recorded in the load ledger with its
+    date range (see data_cleaning.load_ledger), so an interrupted refresh resumes at the file it stopped at.
+    The rollups of the table, if any, are then recomputed over the dates of the files loaded (see rollups.py).
+
+    :param file_names: a *list* of CSV file names, already loaded ones are skipped
+    :param chunk_size: the number of rows per block
+    :param sql_database: the name of the SQLite database file
+    :param table_name: the name of the view, the fact table is named after it
+    :param workers: the number of worker processes (default: the number of cores), 1 to process in this process
+    :param force: load the files even if the ledger has them
+    :return: the number of rows inserted or updated
+    '''
+    conn = sqlite3.connect(sql_database, isolation_level=None) # transactions are managed by hand
+    conn.execute("PRAGMA synchronous=NORMAL")
+
+    rows_loaded = 0
+    loaded_first_day = loaded_last_day = None # over the files loaded by this call, for the rollups
+    try:
+        conn.execute("BEGIN")
+        create_compact_tables(conn, table_name, replace=False)
+        conn.execute("COMMIT")
+
+        for file_name in file_names:
+            if not force and data_cleaning.is_loaded(conn, table_name, file_name):
+                print(f'Skipping {file_name}, already loaded')
+                continue
+
+            file_rows = 0
+            first_day = last_day = None
+            conn.execute("BEGIN")
+            try:
+                for chunk in compact_chunks([file_name], chunk_size, workers):
+                    write_compact_chunk(conn, chunk, table_name)
+                    days = chunk['fact']['epoch_day']
+                    if len(days):
+                        first_day = days.min() if first_day is None else min(first_day, days.min())
+                        last_day = days.max() if last_day is None else max(last_day, days.max())
+                    file_rows += len(chunk['fact'])
+
+                data_cleaning.record_load(conn, table_name, file_name, file_rows,
+                                          None if first_day is None else epoch_day_to_date(first_day),
+                                          None if last_day is None else epoch_day_to_date(last_day))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+            rows_loaded += file_rows
+            if first_day is not None:
+                loaded_first_day = first_day if loaded_first_day is None else min(loaded_first_day, first_day)
+                loaded_last_day = last_day if loaded_last_day is None else max(loaded_last_day, last_day)
+    finally:
+        conn.close()
+
+    # recompute the rollups over the dates just loaded
+    if loaded_first_day is not None:
+        import rollups # imported here: the worker processes import this module, they do not need the query modules
+        rollups.refresh_after_load(sql_database, table_name, epoch_day_to_date(loaded_first_day), epoch_day_to_date(loaded_last_day))
+
+    return rows_loaded
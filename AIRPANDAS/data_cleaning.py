@@ -1,6 +1,20 @@
+import sqlite3
+import io
+import os
+import shutil
+from itertools import islice, chain
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from sqlalchemy import create_engine
 
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError: ## the Parquet output is optional
+    pa = None
+
 def add_fips_column(df, state_col_name, county_col_name):
     '''
     Add a column for the FIPS code to a DataFrame
@@ -11,9 +25,14 @@ def add_fips_column(df, state_col_name, county_col_name):
     :param county_col_name: the name of the column containing the county code
     '''
 
-    df['FIPS'] = df[state_col_name].astype(str).str.zfill(2) + \
-                df[county_col_name].astype(str).str.zfill(3)
+    # build the code once per distinct (state, county) pair, then map it onto the rows
+    pairs = df[[state_col_name, county_col_name]].drop_duplicates()
+    pair_fips = pairs[state_col_name].astype(str).str.zfill(2) + \
+                pairs[county_col_name].astype(str).str.zfill(3)
     ## str.zfill(n): adds zeroes to the left of the string until it reaches a length of n
+    lookup = pd.Series(pair_fips.values, index=pd.MultiIndex.from_frame(pairs))
+
+    df['FIPS'] = lookup.reindex(pd.MultiIndex.from_frame(df[[state_col_name, county_col_name]])).values
     return df
 
 
@@ -84,6 +103,245 @@ def process_aqs_csv_in_chunks(file_names, chunk_size, sql_engine, table_name):
         first_file = False           
 
 
+### fast path for large AQS sample files -- one transaction, no indexes while loading, executemany
+
+## pandas dtypes of the AQS sampleData columns, so read_csv does not have to infer them on every chunk
+aqs_dtypes = {
+    'state_code': 'Int64', 'county_code': 'Int64', 'site_number': 'Int64',
+    'parameter_code': 'Int64', 'poc': 'Int64',
+    'latitude': 'float64', 'longitude': 'float64', 'datum': 'str', 'parameter': 'str',
+    'date_local': 'str', 'time_local': 'str', 'date_gmt': 'str', 'time_gmt': 'str',
+    'sample_measurement': 'float64', 'units_of_measure': 'str', 'units_of_measure_code': 'Int64',
+    'sample_duration': 'str', 'sample_duration_code': 'str', 'sample_frequency': 'str',
+    'detection_limit': 'float64', 'uncertainty': 'float64', 'qualifier': 'str',
+    'method_type': 'str', 'method': 'str', 'method_code': 'str',
+    'state': 'str', 'county': 'str', 'date_of_last_change': 'str', 'cbsa_code': 'Int64',
+}
+
+def sqlite_type(dtype):
+    '''
+    The SQLite column type for a pandas dtype
+    '''
+    if pd.api.types.is_bool_dtype(dtype) or pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return 'TIMESTAMP'
+    return 'TEXT'
+
+def prepare_rows(chunk):
+    '''
+    Turn a processed chunk into plain python tuples for executemany
+    Dates are written the way DataFrame.to_sql writes them, so both loaders build the same table.
+    '''
+    chunk = chunk.copy()
+    for column in chunk.columns:
+        if pd.api.types.is_datetime64_any_dtype(chunk[column]):
+            chunk[column] = chunk[column].dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+    # object dtype turns NaN/NA into None and numpy scalars into python ones
+    chunk = chunk.astype(object).where(chunk.notna(), None)
+    return chunk.itertuples(index=False, name=None)
+
+def bulk_load_pragmas(conn):
+    '''
+    Tune a connection for a bulk load: no fsync, and an in-memory rollback journal unless the database is in WAL
+    (leaving WAL needs exclusive access to the file, it would fail while any other connection is open)
+    '''
+    conn.execute("PRAGMA synchronous=OFF")
+    if conn.execute("PRAGMA journal_mode").fetchone()[0].lower() != 'wal':
+        conn.execute("PRAGMA journal_mode=MEMORY")
+
+def bulk_insert_chunks(chunks, sql_database, table_name, if_exists='replace'):
+    '''
+    Write processed chunks into a SQLite table, the single writer of the bulk loaders:
+    - the indexes on the table are dropped during the load and rebuilt at the end
+    - the whole load is one transaction, with synchronous=OFF and an in-memory journal (see bulk_load_pragmas)
+    - rows are inserted with executemany
+    - the rollups of the table, if any, are recomputed afterwards (see rollups.refresh_after_load)
+
+    :param chunks: an iterable of processed DataFrames (see process_aqs_chunk)
+    :param sql_database: the name of the SQLite database file
+    :param table_name: the name of the table to store the data in
+    :param if_exists: 'replace' the table, or 'append' to it
+    :return: the number of rows loaded
+    '''
+    conn = sqlite3.connect(sql_database, isolation_level=None) # transactions are managed by hand
+    bulk_load_pragmas(conn)
+
+    # defer the indexes: remember them, drop them, and rebuild them once the data is in
+    indexes = conn.execute("SELECT name, sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL",
+                           (table_name,)).fetchall()
+
+    rows_loaded = 0
+    first_date = last_date = None
+    conn.execute("BEGIN")
+    try:
+        for name, _ in indexes:
+            conn.execute(f'DROP INDEX IF EXISTS "{name}"')
+        # the compact layout's view of the table is replaced by a wide table along with its fact table
+        # (the site, county and parameter tables stay, other compact tables may use them)
+        kind = conn.execute("SELECT type FROM sqlite_master WHERE name = ?", (table_name,)).fetchone()
+        if kind is not None and kind[0] == 'view':
+            if if_exists != 'replace':
+                raise ValueError(f"{table_name} is a compact layout view, append to it with compact_schema.load_aqs_compact")
+            import compact_schema # imported here, it imports this module
+            conn.execute(f'DROP VIEW "{table_name}"')
+            conn.execute(f'DROP TABLE IF EXISTS "{compact_schema.fact_table_name(table_name)}"')
+        elif if_exists == 'replace':
+            conn.execute(f'DROP TABLE IF EXISTS "{table_name}"')
+
+        insert_sql = None
+        for chunk in chunks:
+            if insert_sql is None:
+                column_defs = ", ".join(f'"{column}" {sqlite_type(dtype)}' for column, dtype in chunk.dtypes.items())
+                conn.execute(f'CREATE TABLE IF NOT EXISTS "{table_name}" ({column_defs})')
+                column_str = ", ".join(f'"{column}"' for column in chunk.columns)
+                placeholders = ", ".join("?" for _ in chunk.columns)
+                insert_sql = f'INSERT INTO "{table_name}" ({column_str}) VALUES ({placeholders})'
+
+            conn.executemany(insert_sql, prepare_rows(chunk))
+            rows_loaded += len(chunk)
+            if 'date_local' in chunk and len(chunk):
+                dates = chunk['date_local'].astype(str).str[:10]
+                first_date = dates.min() if first_date is None else min(first_date, dates.min())
+                last_date = dates.max() if last_date is None else max(last_date, dates.max())
+
+        print('Rebuilding indexes')
+        for name, sql in indexes:
+            try:
+                conn.execute(sql)
+            except sqlite3.OperationalError as e: # a replaced table may no longer have the indexed columns
+                print(f'Skipping index {name}: {e}')
+
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+    # recompute the rollups of the table, if any: all of them after a replace, the dates loaded after an append
+    import rollups # imported here: the worker processes import this module, they do not need the query modules
+    if if_exists == 'replace':
+        rollups.refresh_after_load(sql_database, table_name)
+    elif first_date is not None:
+        rollups.refresh_after_load(sql_database, table_name, first_date, last_date)
+
+    return rows_loaded
+
+def read_aqs_chunks(file_names, chunk_size, process=process_aqs_chunk):
+    '''
+    Read and process the CSV files chunk by chunk, in this process
+
+    :param process: the function processing each raw chunk
+    :return: a generator of processed DataFrames
+    '''
+    for file_name in file_names:
+        chunk_iter = pd.read_csv(file_name, chunksize=chunk_size, dtype=aqs_dtypes)
+
+        for i, chunk in enumerate(chunk_iter):
+            ## show progress every 10 chunks
+            if i % 10 == 0:
+                print(f'Loading chunk {i} of {file_name}')
+
+            yield process(chunk)
+
+def bulk_load_aqs_csv(file_names, chunk_size, sql_database, table_name, if_exists='replace'):
+    '''
+    Load a list of AQS sample CSV files into a SQLite table much faster than process_aqs_csv_in_chunks:
+    - the indexes on the table are dropped during the load and rebuilt at the end
+    - the whole load is one transaction, with synchronous=OFF and an in-memory journal
+    - rows are inserted with executemany, from columns typed up front (see aqs_dtypes)
+
+    An interrupted load leaves the table incomplete (the in-memory journal cannot roll back a crash),
+    so rerun it with if_exists='replace'.
+
+    :param file_names: a *list* of CSV file names to process
+    :param chunk_size: the number of rows to process at a time
+    :param sql_database: the name of the SQLite database file
+    :param table_name: the name of the table to store the data in
+    :param if_exists: 'replace' the table, or 'append' to it
+    :return: the number of rows loaded
+    '''
+    return bulk_insert_chunks(read_aqs_chunks(file_names, chunk_size), sql_database, table_name, if_exists)
+
+
+### parallel ingestion -- worker processes parse and transform, this process is the single writer
+
+def read_csv_blocks(file_name, chunk_size):
+    '''
+    Split a CSV file into blocks of raw lines, each with the header, without parsing them
+    (assumes no quoted field spans several lines, true for the AQS files)
+
+    :return: a generator of (header, lines) tuples
+    '''
+    with open(file_name, 'r', newline='') as file:
+        header = file.readline()
+        while True:
+            lines = list(islice(file, chunk_size))
+            if not lines:
+                break
+            yield header, lines
+
+def parse_aqs_block(header, lines, process=process_aqs_chunk):
+    '''
+    Worker task: parse a block of raw CSV lines and process it (see process_aqs_chunk)
+    '''
+    chunk = pd.read_csv(io.StringIO(header + ''.join(lines)), dtype=aqs_dtypes)
+    return process(chunk)
+
+def parallel_aqs_chunks(file_names, chunk_size, workers=None, max_pending=None, process=process_aqs_chunk):
+    '''
+    Parse and process the blocks of all the files on a pool of worker processes.
+    At most `max_pending` blocks are in flight: reading waits for the writer to catch up,
+    so memory stays bounded whatever the size of the files.
+
+    :param workers: the number of worker processes (default: the number of cores)
+    :param max_pending: the maximum number of blocks read but not yet written (default: 2 per worker)
+    :param process: the function processing each raw chunk, a module-level function so workers can import it
+    :return: a generator of processed DataFrames, in file order
+    '''
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * workers
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+
+        for file_name in file_names:
+            for i, (header, lines) in enumerate(read_csv_blocks(file_name, chunk_size)):
+                ## show progress every 10 chunks
+                if i % 10 == 0:
+                    print(f'Loading chunk {i} of {file_name}')
+
+                pending.append(executor.submit(parse_aqs_block, header, lines, process))
+                if len(pending) >= max_pending:
+                    yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+def parallel_load_aqs_csv(file_names, chunk_size, sql_database, table_name, if_exists='replace', workers=None, max_pending=None):
+    '''
+    Load a list of AQS sample CSV files like bulk_load_aqs_csv, with the parsing and processing
+    spread over worker processes and this process writing to SQLite (see parallel_aqs_chunks).
+
+    Call it under `if __name__ == '__main__':` -- worker processes re-import the calling script.
+
+    :param file_names: a *list* of CSV file names to process
+    :param chunk_size: the number of rows per block
+    :param sql_database: the name of the SQLite database file
+    :param table_name: the name of the table to store the data in
+    :param if_exists: 'replace' the table, or 'append' to it
+    :param workers: the number of worker processes (default: the number of cores)
+    :param max_pending: the maximum number of blocks in memory at once (default: 2 per worker)
+    :return: the number of rows loaded
+    '''
+    chunks = parallel_aqs_chunks(file_names, chunk_size, workers, max_pending)
+    return bulk_insert_chunks(chunks, sql_database, table_name, if_exists)
+
+
 ## census data is cleaned while requesting, ready to query directly
 def query_census(file_name, sql_engine, table_name):
     '''
@@ -94,9 +352,149 @@ def query_census(file_name, sql_engine, table_name):
     census_df = add_fips_column(census_df, 'state', 'county')
     census_df.to_sql(table_name, sql_engine, if_exists='replace', index=False)
 
+def upsert_census(file_name, sql_database, table_name):
+    '''
+    Insert or update the Census data of a file, keyed on (FIPS, Year), instead of replacing the table:
+    new years are added and the rows already present are updated in place.
+    Columns missing from the table are added to it. The load is recorded in the load ledger.
+
+    :param file_name: the census CSV file
+    :param sql_database: the name of the SQLite database file
+    :param table_name: the name of the census table
+    :return: the number of rows inserted or updated
+    '''
+    census_df = pd.read_csv(file_name, encoding='latin-1')
+    census_df = add_fips_column(census_df, 'state', 'county')
+
+    conn = sqlite3.connect(sql_database)
+    try:
+        with conn: # one transaction
+            existing = [row[1] for row in conn.execute(f'PRAGMA table_info("{table_name}")')]
+            if not existing:
+                column_defs = ", ".join(f'"{column}" {sqlite_type(dtype)}' for column, dtype in census_df.dtypes.items())
+                conn.execute(f'CREATE TABLE "{table_name}" ({column_defs})')
+            else:
+                for column, dtype in census_df.dtypes.items():
+                    if column.lower() not in (name.lower() for name in existing):
+                        conn.execute(f'ALTER TABLE "{table_name}" ADD COLUMN "{column}" {sqlite_type(dtype)}')
+
+            # the natural key of a census row, needed by ON CONFLICT
+            conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS "ux_{table_name}_FIPS_Year" ON "{table_name}" (FIPS, Year)')
+
+            columns = list(census_df.columns)
+            updates = ", ".join(f'"{column}" = excluded."{column}"' for column in columns if column not in ('FIPS', 'Year'))
+            conn.executemany(f'''INSERT INTO "{table_name}" ({", ".join(f'"{column}"' for column in columns)})
+                                 VALUES ({", ".join("?" for _ in columns)})
+                                 ON CONFLICT (FIPS, Year) DO UPDATE SET {updates}''',
+                             prepare_rows(census_df))
 
+            record_load(conn, table_name, file_name, len(census_df),
+                        str(census_df['Year'].min()), str(census_df['Year'].max()))
+    finally:
+        conn.close()
 
+    return len(census_df)
 
 
+### optional Parquet output -- one dataset per table, partitioned by year and state (see database_query.ParquetDatabase)
 
+def write_aqs_parquet(file_names, chunk_size, dataset_dir, table_name='PM25', workers=None):
+    '''
+    Write a list of AQS sample CSV files as a Parquet dataset partitioned by year and state code,
+    <dataset_dir>/<table_name>/year=<year>/state_code=<state>/*.parquet, replacing the dataset if it exists.
+    The chunks are processed like bulk_load_aqs_csv (on worker processes unless workers is 1) and streamed to the writer.
+
+    :param file_names: a *list* of CSV file names to process
+    :param chunk_size: the number of rows per block
+    :param dataset_dir: the folder holding the datasets
+    :param table_name: the name of the dataset
+    :param workers: the number of worker processes (default: the number of cores), 1 to process in this process
+    :return: the number of rows written
+    '''
+    if pa is None:
+        raise ImportError("Parquet output requires pyarrow. Try `pip install pyarrow`.")
+
+    if workers == 1:
+        chunks = read_aqs_chunks(file_names, chunk_size)
+    else:
+        chunks = parallel_aqs_chunks(file_names, chunk_size, workers)
+
+    first = next(chunks, None)
+    if first is None:
+        return 0
+    # every chunk is cast to the first chunk's schema, a chunk full of nulls would otherwise change the types
+    schema = pa.Schema.from_pandas(first, preserve_index=False)
+
+    rows = 0
+    def batches():
+        nonlocal rows
+        for chunk in chain([first], chunks):
+            rows += len(chunk)
+            yield from pa.Table.from_pandas(chunk, schema=schema, preserve_index=False).to_batches()
+
+    table_dir = os.path.join(dataset_dir, table_name)
+    shutil.rmtree(table_dir, ignore_errors=True)
+    ds.write_dataset(batches(), table_dir, schema=schema, format='parquet',
+                     partitioning=['year', 'state_code'], partitioning_flavor='hive')
+    return rows
+
+def write_census_parquet(file_name, dataset_dir, table_name):
+    '''
+    Write the Census data of a file as a Parquet dataset partitioned by Year and state, replacing the dataset if it exists
+    '''
+    if pa is None:
+        raise ImportError("Parquet output requires pyarrow. Try `pip install pyarrow`.")
+
+    census_df = pd.read_csv(file_name, encoding='latin-1')
+    census_df = add_fips_column(census_df, 'state', 'county')
+
+    table_dir = os.path.join(dataset_dir, table_name)
+    shutil.rmtree(table_dir, ignore_errors=True)
+    pq.write_to_dataset(pa.Table.from_pandas(census_df, preserve_index=False), table_dir, partition_cols=['Year', 'state'])
+    return len(census_df)
+
+
+### load ledger -- which files (and date ranges) are already in the database, for incremental loads
 
+ledger_sql = '''
+    CREATE TABLE IF NOT EXISTS load_ledger (
+        table_name TEXT,
+        file_name TEXT,
+        file_size INTEGER,
+        file_mtime REAL,
+        rows INTEGER,
+        first_date TEXT,
+        last_date TEXT,
+        loaded_at TEXT,
+        PRIMARY KEY (table_name, file_name)
+    )'''
+
+def is_loaded(conn, table_name, file_name):
+    '''
+    Whether the file was already loaded into the table, unchanged since (same size and modification time)
+    '''
+    conn.execute(ledger_sql)
+    row = conn.execute("SELECT file_size, file_mtime FROM load_ledger WHERE table_name = ? AND file_name = ?",
+                       (table_name, os.path.abspath(file_name))).fetchone()
+    stat = os.stat(file_name)
+    return row is not None and row[0] == stat.st_size and row[1] == stat.st_mtime
+
+def record_load(conn, table_name, file_name, rows, first_date, last_date):
+    '''
+    Record a loaded file in the ledger, in the caller's transaction
+    '''
+    conn.execute(ledger_sql)
+    stat = os.stat(file_name)
+    conn.execute("INSERT OR REPLACE INTO load_ledger VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now'))",
+                 (table_name, os.path.abspath(file_name), stat.st_size, stat.st_mtime, rows, first_date, last_date))
+
+def load_ledger(sql_database):
+    '''
+    Return the load ledger of the database: one row per loaded file, with its date range
+    '''
+    conn = sqlite3.connect(sql_database)
+    try:
+        conn.execute(ledger_sql)
+        return pd.read_sql_query("SELECT * FROM load_ledger ORDER BY table_name, first_date", conn)
+    finally:
+        conn.close()
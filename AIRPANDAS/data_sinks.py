@@ -0,0 +1,242 @@
+import csv
+import os
+import re
+import sqlite3
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: ## parquet output is optional
+    pa = None
+    pq = None
+
+'''
+Streaming sinks for AQS chunk results
+
+Each chunk's `Data` array (a list of dictionaries, one per row) is written straight to the
+output and then dropped, so memory use does not grow with the date range.
+
+Every sink works the same way:
+    sink.open(resume=False)  -- start a new output, or append to it when resuming a download
+    sink.write(records)      -- write the records of one chunk
+    sink.close()             -- finish the output and return a summary dictionary
+
+Pick one from the output file name with sink_for_file().
+'''
+
+## the numeric fields of the AQS sample records (the codes are strings in the API's JSON), for columns
+## that have no value in the first chunk of a Parquet file; every other field is a string
+aqs_numeric_fields = {
+    'poc': 'int64', 'latitude': 'double', 'longitude': 'double', 'sample_measurement': 'double',
+    'detection_limit': 'double', 'uncertainty': 'double',
+}
+
+
+class _Sink:
+    '''
+    Shared bookkeeping for the sinks: where the data goes and how much was written
+    '''
+    format = None
+
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        self.chunks = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _count(self, records):
+        self.rows += len(records)
+        self.chunks += 1
+
+    def summary(self):
+        return {"format": self.format, "path": self.path, "rows": self.rows, "chunks": self.chunks}
+
+
+class CSVSink(_Sink):
+    '''
+    Append each chunk to a CSV file; the header comes from the first chunk (or the existing file)
+    '''
+    format = "csv"
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.file = None
+        self.writer = None
+
+    def open(self, resume=False):
+        fieldnames = None
+        if resume and os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, "r", newline="") as file:
+                fieldnames = next(csv.reader(file))
+
+        self.file = open(self.path, "a" if fieldnames else "w", newline="")
+        if fieldnames:
+            self.writer = csv.DictWriter(self.file, fieldnames=fieldnames, extrasaction="ignore")
+
+    def write(self, records):
+        if not records:
+            return
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.file, fieldnames=list(records[0].keys()), extrasaction="ignore")
+            self.writer.writeheader()
+
+        self.writer.writerows(records)
+        self.file.flush()
+        self._count(records)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        return self.summary()
+
+
+class ParquetSink(_Sink):
+    '''
+    Write each chunk as a complete Parquet file (requires pyarrow): the first one at `path`,
+    the next ones next to it (e.g. "pm25.part1.parquet", "pm25.part2.parquet").
+
+    A Parquet file can only be read once its footer is written, so each chunk's file is finished
+    (written to a temporary name, then renamed) before the download journals the chunk as done:
+    a crash never leaves a journaled chunk unreadable. Read the files together, e.g.
+    pq.ParquetDataset(sink.part_files()).
+    '''
+    format = "parquet"
+
+    def __init__(self, path):
+        if pa is None:
+            raise ImportError("Parquet output requires pyarrow. Try `pip install pyarrow`.")
+        super().__init__(path)
+        self.schema = None
+
+    def part_files(self):
+        '''
+        The files of the output, in the order they were written
+        '''
+        stem, extension = os.path.splitext(self.path)
+        pattern = re.compile(re.escape(os.path.basename(stem)) + r"\.part(\d+)" + re.escape(extension) + "$")
+        folder = os.path.dirname(os.path.abspath(self.path))
+        parts = sorted((int(match.group(1)), name) for name in os.listdir(folder) for match in [pattern.match(name)] if match)
+        files = [self.path] if os.path.exists(self.path) else []
+        return files + [os.path.join(os.path.dirname(self.path), name) for _, name in parts]
+
+    def _next_file(self):
+        if not os.path.exists(self.path):
+            return self.path
+        stem, extension = os.path.splitext(self.path)
+        part = 1
+        while os.path.exists(f"{stem}.part{part}{extension}"):
+            part += 1
+        return f"{stem}.part{part}{extension}"
+
+    def open(self, resume=False):
+        if not resume:
+            # start over: the files of an earlier output (e.g. of another request, see ChunkManifest.reset) go too
+            for file_name in self.part_files():
+                os.remove(file_name)
+        elif os.path.exists(self.path):
+            # the chunks added to the output keep the types of its first file
+            self.schema = pq.read_schema(self.path)
+
+    def write(self, records):
+        if not records:
+            return
+        table = pa.Table.from_pylist(records)
+        if self.schema is None:
+            # a column with no value in the first chunk is inferred as type null, give it its AQS type instead
+            self.schema = pa.schema([pa.field(field.name, pa.type_for_alias(aqs_numeric_fields.get(field.name, "string")))
+                                     if pa.types.is_null(field.type) else field
+                                     for field in table.schema])
+
+        # conform every chunk to the output's schema: null (or otherwise inferred) columns are cast, missing columns are null
+        columns = [table.column(field.name).cast(field.type) if field.name in table.column_names else pa.nulls(len(table), field.type)
+                   for field in self.schema]
+
+        file_name = self._next_file()
+        pq.write_table(pa.Table.from_arrays(columns, schema=self.schema), file_name + ".tmp")
+        os.replace(file_name + ".tmp", file_name)
+        self._count(records)
+
+    def close(self):
+        summary = self.summary()
+        summary["files"] = self.part_files()
+        return summary
+
+
+class SQLiteSink(_Sink):
+    '''
+    Insert each chunk directly into a SQLite table, committing once per chunk
+
+    :param path: the SQLite database file
+    :param table_name: the table to insert into, created from the first chunk if missing
+    '''
+    format = "sqlite"
+
+    def __init__(self, path, table_name="aqs_data"):
+        super().__init__(path)
+        self.table_name = table_name
+        self.conn = None
+        self.columns = None
+
+    def open(self, resume=False):
+        self.conn = sqlite3.connect(self.path)
+        if not resume:
+            self.conn.execute(f'DROP TABLE IF EXISTS "{self.table_name}"')
+            self.conn.commit()
+        else:
+            columns = [row[1] for row in self.conn.execute(f'PRAGMA table_info("{self.table_name}")')]
+            self.columns = columns or None
+
+    def _create_table(self, record):
+        # SQLite types from the first record's python values
+        def sql_type(value):
+            if isinstance(value, bool) or isinstance(value, int):
+                return "INTEGER"
+            if isinstance(value, float):
+                return "REAL"
+            return "TEXT"
+
+        self.columns = list(record.keys())
+        column_defs = ", ".join(f'"{column}" {sql_type(record[column])}' for column in self.columns)
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{self.table_name}" ({column_defs})')
+
+    def write(self, records):
+        if not records:
+            return
+        if self.columns is None:
+            self._create_table(records[0])
+
+        column_str = ", ".join(f'"{column}"' for column in self.columns)
+        placeholders = ", ".join("?" for _ in self.columns)
+        self.conn.executemany(f'INSERT INTO "{self.table_name}" ({column_str}) VALUES ({placeholders})',
+                              ([record.get(column) for column in self.columns] for record in records))
+        self.conn.commit()
+        self._count(records)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        summary = self.summary()
+        summary["table"] = self.table_name
+        return summary
+
+
+def sink_for_file(file_name, table_name="aqs_data"):
+    '''
+    Choose a sink from the output file extension: .parquet, .sqlite/.db, anything else is CSV
+
+    :param file_name: the output file
+    :param table_name: the table to insert into for SQLite output
+    '''
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension == ".parquet":
+        return ParquetSink(file_name)
+    if extension in (".sqlite", ".db"):
+        return SQLiteSink(file_name, table_name)
+    return CSVSink(file_name)
@@ -1,4 +1,8 @@
 import data_cleaning
+import index_manager
+import compact_schema
+import rollups
+import database_query as dbq
 from sqlalchemy import create_engine
 
 '''
@@ -11,7 +15,7 @@ then change the file paths and names in the main() function.
 
 For AQS data, we only handle the sampleData, not the dailyData. (i.e. this handle any AQS dataframe with hourly data)
 
-You can also change the name of the output database
+You can also change the name of the output database, and choose the storage layout of the PM25 data
 
 '''
 
@@ -19,6 +23,9 @@ You can also change the name of the output database
 def main():
 
     output_database_name = 'airpandas_1.sqlite' ## YOU CAN CHANGE THIS NAME
+    compact = True ## store PM25 in the compact layout, False for the original single wide table
+    incremental = False ## True: only load the files not loaded yet into an existing database (compact layout only)
+    parquet_dir = None ## e.g. 'airpandas_parquet': also write the tables as Parquet datasets, read with database_query.connect(parquet_dir) (requires pyarrow)
     engine = create_engine(f'sqlite:///{output_database_name}')
 
     
@@ -36,10 +43,42 @@ def main():
     }
 
     for table_name, file_name in census_file_name.items():
-        data_cleaning.query_census(file_name, engine, table_name)
+        if incremental:
+            data_cleaning.upsert_census(file_name, output_database_name, table_name)
+        else:
+            data_cleaning.query_census(file_name, engine, table_name)
 
     file_names = [r'database\2009_2014.6_CA_PM2.5_samples.csv', r'database\2014.6_2021_CA_PM2.5_samples.csv']
-    data_cleaning.process_csv_in_chunks(file_names, 10000, engine, 'PM25')
+    if incremental:
+        # upsert the new files on the natural key of the measurements, see data_cleaning.load_ledger for what is loaded;
+        # the rollups are recomputed over the dates of the files loaded
+        compact_schema.upsert_aqs_compact(file_names, 100000, output_database_name, 'PM25')
+    elif compact:
+        # PM25 becomes a view over a narrow fact table and site/county/parameter tables (see compact_schema.py)
+        compact_schema.load_aqs_compact(file_names, 100000, output_database_name, 'PM25')
+    else:
+        # worker processes parse the CSV blocks, this process writes them (see data_cleaning.parallel_load_aqs_csv)
+        data_cleaning.parallel_load_aqs_csv(file_names, 100000, output_database_name, 'PM25')
+
+    if not rollups.has_rollups(output_database_name, 'PM25'):
+        # county-day and county-year aggregates, read by the query and plotting functions instead of the raw rows
+        # (once they exist, the loaders keep them up to date)
+        rollups.build_rollups(output_database_name, 'PM25')
+
+    if parquet_dir is not None:
+        # partitioned by year and state, so readers only open the partitions they need
+        for table_name, file_name in census_file_name.items():
+            data_cleaning.write_census_parquet(file_name, parquet_dir, table_name)
+        data_cleaning.write_aqs_parquet(file_names, 100000, parquet_dir, 'PM25')
+
+    # index the access patterns of the query and plotting functions, then show how each one is served
+    index_manager.ensure_indexes(output_database_name)
+    print(index_manager.index_report(output_database_name).to_string())
+
+    # WAL: the GUI and plotting functions can query the database while it is refreshed (stored in the database file)
+    engine.dispose()
+    dbq.connect(output_database_name).close()
+    dbq.enable_wal(output_database_name)
 
 
 
@@ -1,43 +1,666 @@
 import sqlite3
+import threading
+import os
+from datetime import datetime, timedelta
 import pandas as pd
 import plotly.express as px
 import json
+import query_cache
+import geometry
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError: ## the Parquet backend is optional
+    pa = None
+    ds = None
 
 ### defaultly you need the sqlite databse in the root directory
 
-def get_all_tables(sql_database):
+### building SQL -- bound parameters only, names checked against the schema
+
+class QueryBuilder:
     '''
-    Returns a list of all tables in the database
+    Builds SELECT statements with bound parameters (so SQLite can reuse the prepared statement),
+    after checking table and column names against a cached schema.
 
-    :param sql_database: the name of the SQL database to query
+    The date predicate is picked per table: a year range filters on the table's year column,
+    a YYYY-MM-DD date range filters on date_local (the end date is inclusive).
+    On a compact layout view (see compact_schema.py) dates and FIPS codes filter on the integer
+    epoch_day and fips_code columns instead, so the fact table indexes are used.
+
+    :param schema: a {table name: [column names]} dictionary, see Database.schema()
     '''
-    conn = sqlite3.connect(sql_database)
-    cursor = conn.cursor()
+    def __init__(self, schema):
+        self.schema = schema
+
+    def check_table(self, table_name):
+        if table_name not in self.schema:
+            raise ValueError(f"Unknown table: {table_name}")
+
+    def column(self, table_name, column):
+        '''
+        Return the column as named in the schema (SQLite names are case-insensitive), or raise ValueError
+        '''
+        self.check_table(table_name)
+        for name in self.schema[table_name]:
+            if name.lower() == str(column).strip().lower():
+                return name
+        raise ValueError(f"Unknown column {column} in table {table_name}")
+
+    def has_column(self, table_name, column):
+        try:
+            self.column(table_name, column)
+            return True
+        except ValueError:
+            return False
+
+    @staticmethod
+    def is_year(value):
+        return isinstance(value, int) or (isinstance(value, str) and value.strip().isdigit() and len(value.strip()) == 4)
+
+    def date_predicate(self, table_name, start_date, end_date):
+        '''
+        Return the (sql, params) predicate for a date range on the table
+
+        :param start_date: a year, or a date in the format YYYY-MM-DD
+        :param end_date: a year, or a date in the format YYYY-MM-DD (inclusive)
+        '''
+        if self.is_year(start_date) and self.is_year(end_date):
+            year_column = self.column(table_name, 'year')
+            return f'"{year_column}" BETWEEN ? AND ?', [int(start_date), int(end_date)]
+
+        if not self.has_column(table_name, 'date_local'):
+            # census tables only have years, use the years of the dates
+            year_column = self.column(table_name, 'year')
+            return f'"{year_column}" BETWEEN ? AND ?', [int(str(start_date)[:4]), int(str(end_date)[:4])]
+
+        if self.has_column(table_name, 'epoch_day'):
+            try:
+                epoch = datetime(1970, 1, 1)
+                start_day = (datetime.strptime(str(start_date).strip(), '%Y-%m-%d') - epoch).days
+                end_day = (datetime.strptime(str(end_date).strip(), '%Y-%m-%d') - epoch).days
+                return '"epoch_day" BETWEEN ? AND ?', [start_day, end_day]
+            except ValueError:
+                pass
+
+        try:
+            # date_local is stored with a time ("2020-12-31 00:00:00"), so include the whole end day
+            end_day = datetime.strptime(str(end_date).strip(), '%Y-%m-%d') + timedelta(days=1)
+            return 'date_local >= ? AND date_local < ?', [str(start_date).strip(), end_day.strftime('%Y-%m-%d')]
+        except ValueError:
+            return 'date_local BETWEEN ? AND ?', [str(start_date), str(end_date)]
+
+    def select(self, table_name, columns, start_date=None, end_date=None, fips=None, distinct=False, extra_conditions=None):
+        '''
+        Build a SELECT statement
+
+        :param columns: a list of column names
+        :param start_date: the start of the date range (optional, see date_predicate)
+        :param end_date: the end of the date range (optional)
+        :param fips: a FIPS code or a list of FIPS codes (optional)
+        :param distinct: SELECT DISTINCT
+        :param extra_conditions: a list of (column, value) equality conditions (optional)
+        :return: the sql string and the list of parameters
+        '''
+        column_str = ", ".join(f'"{self.column(table_name, column)}"' for column in columns)
+        conditions, params = self.conditions(table_name, start_date, end_date, fips)
+
+        for column, value in (extra_conditions or []):
+            conditions.append(f'"{self.column(table_name, column)}" = ?')
+            params.append(value)
+
+        sql = f'SELECT {"DISTINCT " if distinct else ""}{column_str} FROM "{table_name}"'
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        return sql, params
+
+    def conditions(self, table_name, start_date=None, end_date=None, fips=None):
+        '''
+        Build the WHERE conditions for a date range and FIPS codes
+
+        :return: a list of sql conditions (to be joined with AND) and the list of parameters
+        '''
+        self.check_table(table_name)
+        conditions = []
+        params = []
+
+        if start_date is not None and end_date is not None:
+            predicate, predicate_params = self.date_predicate(table_name, start_date, end_date)
+            conditions.append(predicate)
+            params.extend(predicate_params)
+
+        if fips is not None:
+            if self.has_column(table_name, 'fips_code'):
+                fips_column, to_param = 'fips_code', int # compact layout, FIPS is stored as an integer
+            else:
+                fips_column, to_param = self.column(table_name, 'FIPS'), str
+
+            if isinstance(fips, (str, int)):
+                conditions.append(f'"{fips_column}" = ?')
+                params.append(to_param(fips))
+            else:
+                conditions.append(f'"{fips_column}" IN ({", ".join("?" for _ in fips)})')
+                params.extend(to_param(code) for code in fips)
+
+        return conditions, params
+
+
+### pre-aggregated rollups of a measurement table (built by rollups.py), read instead of the raw rows when they can answer
+
+def rollup_table(table_name, granularity):
+    '''
+    The name of the "daily" or "annual" rollup of a measurement table
+    '''
+    return f"{table_name}_{granularity}"
+
+def histogram_table(table_name):
+    '''
+    The name of the histogram of a measurement table, see rollups.build_histograms
+    '''
+    return f"{table_name}_histogram"
 
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = cursor.fetchall()
+def threshold_column(op, threshold):
+    '''
+    The rollup column counting the measurements "gt" (above) or "ge" (at or above) a threshold
+    '''
+    return f"{op}_{threshold:g}".replace(".", "_")
 
-    conn.close()
 
-    return [table[0] for table in tables]
+### a reusable handle on one database -- pooled connections, tuned PRAGMAs and a cached schema
 
-def get_column_names(table_name, sql_database):
+class Database:
     '''
-    Returns a list of all columns in the table
+    A handle on one SQLite database, reused across queries instead of connecting every time.
 
-    :param table_name: the name of the table to query
-    :param sql_database: the name of the SQL database to query
+    Each thread gets its own pooled connection, opened read-only where possible and tuned with PRAGMAs
+    (memory-mapped I/O, a larger page cache, in-memory temp tables). Writes (e.g. create_index) go
+    through a separate writable connection per thread. The journal mode of the database file is left
+    as it is (see enable_wal). The table and column names are loaded once and cached.
+
+    The module-level functions below are wrappers around the methods, see connect().
+
+    :param sql_database: the name of the SQL database
+    :param read_only: open the query connections read-only
+    :param mmap_size: bytes of the database file to memory-map
+    :param cache_size: page cache size in KiB
     '''
+    def __init__(self, sql_database, read_only=True, mmap_size=256 * 1024 ** 2, cache_size=64 * 1024):
+        self.sql_database = sql_database
+        self.read_only = read_only
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+
+        self._local = threading.local()
+        self._connections = [] # every connection handed out, to close them all
+        self._lock = threading.Lock()
+        self._schema = None
+
+    def _connect(self, read_only):
+        if read_only:
+            uri = f"file:{os.path.abspath(self.sql_database)}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=256)
+        else:
+            conn = sqlite3.connect(self.sql_database, check_same_thread=False, cached_statements=256)
+            conn.execute("PRAGMA synchronous=NORMAL")
+
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        conn.execute(f"PRAGMA cache_size={-int(self.cache_size)}") # negative: KiB instead of pages
+        conn.execute("PRAGMA temp_store=MEMORY")
+
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def connection(self):
+        '''
+        Return this thread's query connection, opening it on first use
+        '''
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect(self.read_only)
+        return conn
+
+    def write_connection(self):
+        '''
+        Return this thread's writable connection, opening it on first use
+        '''
+        if not self.read_only:
+            return self.connection()
+
+        conn = getattr(self._local, "write_conn", None)
+        if conn is None:
+            conn = self._local.write_conn = self._connect(False)
+        return conn
+
+    def close(self):
+        '''
+        Close every pooled connection, from all threads
+        '''
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+
+    def schema(self):
+        '''
+        Return the cached {table name: [column names]} of the database, loading it on first use
+        '''
+        if self._schema is None:
+            conn = self.connection()
+            tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view');")]
+            self._schema = {table: [column[1] for column in conn.execute(f'PRAGMA table_info("{table}")')]
+                            for table in tables}
+        return self._schema
+
+    def query_builder(self):
+        '''
+        Return a QueryBuilder checking names against the cached schema
+        '''
+        return QueryBuilder(self.schema())
+
+    def refresh_schema(self):
+        '''
+        Forget the cached schema, e.g. after tables were added by another connection
+        '''
+        self._schema = None
+
+    def get_all_tables(self):
+        return list(self.schema().keys())
+
+    def get_column_names(self, table_name):
+        return list(self.schema().get(table_name, []))
+
+    def column_types(self, table_name):
+        '''
+        Return the {column name: declared SQLite type} of a table or view ('' for untyped view columns)
+        '''
+        QueryBuilder(self.schema()).check_table(table_name)
+        return {column[1]: column[2] for column in self.connection().execute(f'PRAGMA table_info("{table_name}")')}
+
+    def create_index(self, table_name, columns):
+        # If columns is a string, make it a single-item list
+        if isinstance(columns, str):
+            columns = [columns]
+
+        conn = self.write_connection()
+        column_str = ", ".join(columns)
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_{'_'.join(columns)} ON {table_name} ({column_str})")
+        conn.commit()
+
+    def query_table(self, table_name, columns, start_date, end_date, fips=None):
+        sql, params = self.query_builder().select(table_name, columns, start_date, end_date, fips)
+        return pd.read_sql_query(sql, self.connection(), params=params)
+
+    def iter_table(self, table_name, columns, start_date, end_date, fips=None, batch_size=100000):
+        sql, params = self.query_builder().select(table_name, columns, start_date, end_date, fips)
+
+        # SQLite steps the statement as rows are fetched, only one batch is in memory at a time
+        cursor = self.connection().execute(sql, params)
+        names = [description[0] for description in cursor.description]
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield pd.DataFrame.from_records(rows, columns=names)
+        finally:
+            cursor.close()
+
+    def get_unique_sites(self, table_name):
+        sql, params = self.query_builder().select(table_name, ['latitude', 'longitude'], distinct=True)
+        return pd.read_sql_query(sql, self.connection(), params=params)
+
+    def get_unique_fips(self, table_name):
+        sql, params = self.query_builder().select(table_name, ['FIPS'], distinct=True)
+        return pd.read_sql_query(sql, self.connection(), params=params)
+
+    def get_county_fips(self, table_name, state=None, state_column='state', county_column='county', fips_column='FIPS'):
+        # Add a WHERE clause if a state is specified
+        extra_conditions = [(state_column, state)] if state else None
+
+        sql, params = self.query_builder().select(table_name, [fips_column, county_column], distinct=True, extra_conditions=extra_conditions)
+        return pd.read_sql_query(sql, self.connection(), params=params)
+
+    def rollup_for(self, table_name, thresholds, start_date=None, end_date=None, op="gt"):
+        '''
+        Return the rollup of the table that can count the thresholds over the date range, or None
+        (whole years: the annual rollup, whole days: the daily rollup; see rollups.py)
+
+        :param thresholds: a list of thresholds
+        :param op: "gt" to count the measurements above the thresholds, "ge" at or above
+        '''
+        builder = self.query_builder()
+        if start_date is None or end_date is None or (builder.is_year(start_date) and builder.is_year(end_date)):
+            candidates = ["annual", "daily"]
+        else:
+            try:
+                for date in (start_date, end_date):
+                    datetime.strptime(str(date).strip(), '%Y-%m-%d')
+            except ValueError:
+                return None
+            candidates = ["daily"]
+
+        for granularity in candidates:
+            rollup = rollup_table(table_name, granularity)
+            if all(builder.has_column(rollup, threshold_column(op, threshold)) for threshold in thresholds):
+                return rollup
+        return None
+
+    def histogram_exceedance(self, table_name, threshold, start_date=None, end_date=None, fips=None, op="gt"):
+        '''
+        Estimate the share of measurements above (op "gt") or at or above ("ge") any threshold from the histogram
+        of the table (see rollups.build_histograms), without reading the measurements.
+        The bin holding the threshold is split linearly; its whole count is the error bound.
+
+        :param start_date: a year, or with a histogram by month a date in the format YYYY-MM-DD starting a month
+        :param end_date: a year, or with a histogram by month a date in the format YYYY-MM-DD ending a month
+        :return: a DataFrame with a row per FIPS code: total_count, exceed_count (estimated) and error_bound,
+                 the largest possible error of exceed_count / total_count; None if the histogram cannot answer
+        '''
+        histogram = histogram_table(table_name)
+        builder = self.query_builder()
+        if not builder.has_column(histogram, 'bin'):
+            return None
+        bin_width, granularity = self.connection().execute(
+            "SELECT bin_width, granularity FROM histogram_settings WHERE table_name = ?", (table_name,)).fetchone()
+
+        conditions, params = builder.conditions(histogram, fips=fips)
+        if start_date is not None and end_date is not None:
+            if builder.is_year(start_date) and builder.is_year(end_date):
+                conditions.append("year BETWEEN ? AND ?")
+                params += [int(start_date), int(end_date)]
+            else:
+                try:
+                    start = datetime.strptime(str(start_date).strip(), '%Y-%m-%d')
+                    end = datetime.strptime(str(end_date).strip(), '%Y-%m-%d')
+                except ValueError:
+                    return None
+                if granularity != "month" or start.day != 1 or (end + timedelta(days=1)).day != 1:
+                    return None # the histogram only has whole months
+                conditions.append("year * 100 + month BETWEEN ? AND ?")
+                params += [start.year * 100 + start.month, end.year * 100 + end.month]
+        where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        # bin k holds [k * width, (k + 1) * width): above the threshold, below it, or holding it
+        width, threshold = float(bin_width), float(threshold)
+        above = f"bin * {width!r} {'>' if op == 'gt' else '>='} {threshold!r}"
+        holding = f"(bin + 1) * {width!r} > {threshold!r}"
+
+        df = pd.read_sql_query(f"""
+            SELECT FIPS, SUM(count) AS total_count,
+                SUM(CASE WHEN {above} THEN count WHEN {holding} THEN count * ((bin + 1) * {width!r} - {threshold!r}) / {width!r} ELSE 0 END) AS exceed_count,
+                SUM(CASE WHEN {above} THEN 0 WHEN {holding} THEN count ELSE 0 END) AS uncertain_count
+            FROM "{histogram}"
+            {where_clause}
+            GROUP BY FIPS
+            """, self.connection(), params=params)
+
+        df["error_bound"] = df.pop("uncertain_count") / df["total_count"]
+        return df
+
+    def get_poorair_percentages(self, table_name, thresholds, fips=None, start_date=None, end_date=None, max_error=None):
+        if isinstance(thresholds, (int, float)):
+            thresholds = [thresholds]
+
+        builder = self.query_builder()
+        rollup = self.rollup_for(table_name, thresholds, start_date, end_date)
+
+        if rollup is None and max_error is not None:
+            # estimate from the histogram, if it is precise enough for every county
+            estimates = [self.histogram_exceedance(table_name, threshold, start_date, end_date, fips) for threshold in thresholds]
+            if all(estimate is not None and (estimate["error_bound"] <= max_error).all() for estimate in estimates):
+                df = estimates[0][["FIPS", "total_count"]].copy()
+                for threshold, estimate in zip(thresholds, estimates):
+                    df[f"Percentage_{threshold:g}"] = estimate["exceed_count"] / estimate["total_count"] * 100
+                return df
+
+        if rollup is not None:
+            # sum the pre-counted measurements of the rollup rows instead of scanning the raw ones
+            conditions, params = builder.conditions(rollup, start_date, end_date, fips)
+            select = ", ".join(["SUM(count) AS total_count"] +
+                               [f"SUM({threshold_column('gt', threshold)}) AS threshold_count_{i}" for i, threshold in enumerate(thresholds)])
+            source, fips_column, threshold_params = rollup, 'FIPS', []
+        else:
+            conditions, params = builder.conditions(table_name, start_date, end_date, fips)
+            measurement_column = builder.column(table_name, 'sample_measurement')
+
+            # one count of the measurements exceeding each threshold
+            select = ", ".join(["COUNT(*) as total_count"] +
+                               [f'SUM(CASE WHEN "{measurement_column}" > ? THEN 1 ELSE 0 END) AS threshold_count_{i}' for i in range(len(thresholds))])
+            source, fips_column, threshold_params = table_name, builder.column(table_name, 'FIPS'), list(thresholds)
+
+        where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        df = pd.read_sql_query(f"""
+            SELECT "{fips_column}" AS FIPS, {select}
+            FROM "{source}"
+            {where_clause}
+            GROUP BY "{fips_column}"
+            """, self.connection(), params=threshold_params + params)
+
+        # Calculate the percentage of measurements that exceed each threshold
+        for i, threshold in enumerate(thresholds):
+            df[f"Percentage_{threshold:g}"] = df.pop(f"threshold_count_{i}") / df["total_count"] * 100
+
+        return df
+
+    def get_poorair_percentage(self, table_name, fips, threshold, start_date=None, end_date=None):
+        df = self.get_poorair_percentages(table_name, threshold, fips, start_date, end_date)
+
+        if len(df) == 0:
+            percentage = None  # No measurements were taken in the given date range
+            print(f"No measurements were taken in the given date range for FIPS code: {fips}")
+        else:
+            percentage = df.iloc[0, -1]
+            print(f"Calculation done on FIPS code: {fips}")
 
+        return percentage
+
+    def air_threshold_percentages(self, df_counties, table_name, threshold, begin_year=2009, end_year=2021):
+        df_percentages = pd.DataFrame(df_counties.values, columns=['FIPS', 'County'])
+
+        df = self.get_poorair_percentages(table_name, threshold, list(df_percentages['FIPS']), begin_year, end_year)
+
+        # counties without measurements get no percentage
+        percentages = df.set_index('FIPS').iloc[:, -1]
+        df_percentages['Percentage'] = df_percentages['FIPS'].map(percentages)
+        return df_percentages
+
+
+### the optional Parquet backend -- a folder of Parquet datasets, one per table, partitioned by year and state
+
+class ParquetDatabase:
+    '''
+    Read-only stand-in for Database over Parquet datasets written by data_cleaning.write_aqs_parquet and
+    data_cleaning.write_census_parquet (requires pyarrow): <folder>/<table>/<year=...>/<state=...>/*.parquet
+
+    Only the requested columns are read (column projection), and the date range and FIPS codes are pushed down
+    to the reader: partitions outside the years are skipped, and row groups outside the dates or counties are
+    skipped using the Parquet statistics.
+
+    :param dataset_dir: the folder holding the datasets
+    '''
+    def __init__(self, dataset_dir):
+        if ds is None:
+            raise ImportError("The Parquet backend requires pyarrow. Try `pip install pyarrow`.")
+        self.dataset_dir = dataset_dir
+        self._datasets = {}
+        self._schema = None
+
+    def dataset(self, table_name):
+        QueryBuilder(self.schema()).check_table(table_name)
+        if table_name not in self._datasets:
+            self._datasets[table_name] = ds.dataset(os.path.join(self.dataset_dir, table_name), format="parquet", partitioning="hive")
+        return self._datasets[table_name]
+
+    def schema(self):
+        if self._schema is None:
+            tables = sorted(name for name in os.listdir(self.dataset_dir) if os.path.isdir(os.path.join(self.dataset_dir, name)))
+            self._schema = {table: ds.dataset(os.path.join(self.dataset_dir, table), format="parquet", partitioning="hive").schema.names
+                            for table in tables}
+        return self._schema
+
+    def refresh_schema(self):
+        self._schema = None
+        self._datasets = {}
+
+    def close(self):
+        self.refresh_schema()
+
+    def get_all_tables(self):
+        return list(self.schema().keys())
+
+    def get_column_names(self, table_name):
+        return list(self.schema().get(table_name, []))
+
+    def column_types(self, table_name):
+        '''
+        Return the {column name: Arrow type} of a dataset
+        '''
+        schema = self.dataset(table_name).schema
+        return dict(zip(schema.names, schema.types))
+
+    def create_index(self, table_name, columns):
+        print("Parquet datasets have no indexes, the reads are pruned by partition and row group statistics instead")
+
+    def filter(self, table_name, start_date=None, end_date=None, fips=None, extra_conditions=None):
+        '''
+        Build the pyarrow filter expression for a date range and FIPS codes (see QueryBuilder.conditions)
+        '''
+        builder = QueryBuilder(self.schema())
+        expressions = []
+
+        if start_date is not None and end_date is not None:
+            year = ds.field(builder.column(table_name, 'year'))
+            if builder.is_year(start_date) and builder.is_year(end_date):
+                expressions.append((year >= int(start_date)) & (year <= int(end_date)))
+            else:
+                # the year bounds prune the partitions, the dates the row groups
+                expressions.append((year >= int(str(start_date)[:4])) & (year <= int(str(end_date)[:4])))
+                if builder.has_column(table_name, 'date_local'):
+                    date = ds.field(builder.column(table_name, 'date_local'))
+                    end_day = datetime.strptime(str(end_date).strip(), '%Y-%m-%d') + timedelta(days=1)
+                    expressions.append((date >= datetime.strptime(str(start_date).strip(), '%Y-%m-%d')) & (date < end_day))
+
+        if fips is not None:
+            fips_field = ds.field(builder.column(table_name, 'FIPS'))
+            if isinstance(fips, (str, int)):
+                expressions.append(fips_field == str(fips))
+            else:
+                expressions.append(fips_field.isin([str(code) for code in fips]))
+
+        for column, value in (extra_conditions or []):
+            expressions.append(ds.field(builder.column(table_name, column)) == value)
+
+        expression = None
+        for item in expressions:
+            expression = item if expression is None else expression & item
+        return expression
+
+    def read(self, table_name, columns, start_date=None, end_date=None, fips=None, extra_conditions=None):
+        '''
+        Read the columns of the rows in the date range and counties, as a DataFrame
+        '''
+        builder = QueryBuilder(self.schema())
+        columns = [builder.column(table_name, column) for column in columns]
+        table = self.dataset(table_name).to_table(columns=columns, filter=self.filter(table_name, start_date, end_date, fips, extra_conditions))
+        return table.to_pandas()
+
+    def query_table(self, table_name, columns, start_date, end_date, fips=None):
+        return self.read(table_name, columns, start_date, end_date, fips)
+
+    def iter_table(self, table_name, columns, start_date, end_date, fips=None, batch_size=100000):
+        builder = QueryBuilder(self.schema())
+        columns = [builder.column(table_name, column) for column in columns]
+        scanner = self.dataset(table_name).scanner(columns=columns, filter=self.filter(table_name, start_date, end_date, fips),
+                                                    batch_size=batch_size)
+        for batch in scanner.to_batches():
+            if batch.num_rows > 0:
+                yield batch.to_pandas()
+
+    def get_unique_sites(self, table_name):
+        return self.read(table_name, ['latitude', 'longitude']).drop_duplicates().reset_index(drop=True)
+
+    def get_unique_fips(self, table_name):
+        return self.read(table_name, ['FIPS']).drop_duplicates().reset_index(drop=True)
+
+    def get_county_fips(self, table_name, state=None, state_column='state', county_column='county', fips_column='FIPS'):
+        extra_conditions = [(state_column, state)] if state else None
+        return self.read(table_name, [fips_column, county_column], extra_conditions=extra_conditions).drop_duplicates().reset_index(drop=True)
+
+    def get_poorair_percentages(self, table_name, thresholds, fips=None, start_date=None, end_date=None, max_error=None):
+        if isinstance(thresholds, (int, float)):
+            thresholds = [thresholds]
+
+        df = self.read(table_name, ['FIPS', 'sample_measurement'], start_date, end_date, fips)
+        df.columns = ['FIPS', 'sample_measurement']
+        grouped = df.groupby('FIPS')
+
+        result = grouped.size().rename('total_count').reset_index()
+        for threshold in thresholds:
+            counts = (df['sample_measurement'] > threshold).groupby(df['FIPS']).sum()
+            result[f"Percentage_{threshold:g}"] = result['FIPS'].map(counts).values / result['total_count'] * 100
+        return result
+
+    # these only combine the calls above, the same code works for both backends
+    get_poorair_percentage = Database.get_poorair_percentage
+    air_threshold_percentages = Database.air_threshold_percentages
+
+
+## one shared Database per file, used by the module-level functions
+_databases = {}
+_databases_lock = threading.Lock()
+
+def connect(sql_database):
+    '''
+    Return the shared Database for a file, creating it on first use
+    A folder is opened as a ParquetDatabase (see data_cleaning.write_aqs_parquet)
+
+    :param sql_database: the name of the SQL database, or a folder of Parquet datasets
+    '''
+    key = os.path.abspath(sql_database)
+    with _databases_lock:
+        if key not in _databases:
+            _databases[key] = ParquetDatabase(sql_database) if os.path.isdir(sql_database) else Database(sql_database)
+        return _databases[key]
+
+
+def enable_wal(sql_database):
+    '''
+    Switch a database to WAL, so queries are not blocked while it is written to (and the other way around).
+    The mode is stored in the database file: run it once, when the database is created (see database_creator.py),
+    with no other connection to the database open. The loaders keep working on a database in WAL.
+
+    :param sql_database: the name of the SQL database
+    :return: the journal mode of the database
+    '''
     conn = sqlite3.connect(sql_database)
-    cursor = conn.cursor()
+    try:
+        return conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+    finally:
+        conn.close()
+
+
+### the functions below keep the original interface, each one wraps a Database method
+
+def get_all_tables(sql_database):
+    '''
+    Returns a list of all tables in the database
 
-    cursor.execute(f"PRAGMA table_info({table_name})")
-    columns = cursor.fetchall()
+    :param sql_database: the name of the SQL database to query
+    '''
+    return connect(sql_database).get_all_tables()
 
-    conn.close()
+def get_column_names(table_name, sql_database):
+    '''
+    Returns a list of all columns in the table
 
-    return [column[1] for column in columns]
+    :param table_name: the name of the table to query
+    :param sql_database: the name of the SQL database to query
+    '''
+    return connect(sql_database).get_column_names(table_name)
 
 
 ## indexing the database --- very important for speed!!
@@ -51,17 +674,7 @@ def create_index(sql_database, table_name, columns):
     :param columns: a list of columns to return
 
     '''
-    conn = sqlite3.connect(sql_database)
-    c = conn.cursor()
-
-    # If columns is a string, make it a single-item list
-    if isinstance(columns, str):
-        columns = [columns]
-
-    column_str = ", ".join(columns)
-    c.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_{'_'.join(columns)} ON {table_name} ({column_str})")
-    conn.commit()
-    conn.close()
+    connect(sql_database).create_index(table_name, columns)
 
 ### aceessing the database
 
@@ -76,61 +689,88 @@ def query_table(sql_database, table_name, columns, start_date, end_date, fips=No
     :param end_date: the end date of the date range to query (either a year or a date in the format YYYY-MM-DD)
     :param fips: the FIPS code to query (optional)
     '''
+    return connect(sql_database).query_table(table_name, columns, start_date, end_date, fips)
 
-    conn = sqlite3.connect(sql_database)
-
-    # Initialize the WHERE clause with the date range
-    if table_name == 'PM25': ## for now, we only have PM25 table for air quality
-        where_clause = f"date_local BETWEEN '{start_date}' AND '{end_date}'"
-    else: ## other tables are all census tables
-        where_clause = f"Year BETWEEN {start_date} AND {end_date}"
-
-    # If a FIPS code is provided, add it to the WHERE clause
-    if fips is not None:
-        where_clause += f" AND FIPS = '{fips}'"
+def iter_table(sql_database, table_name, columns, start_date, end_date, fips=None, batch_size=100000):
+    '''
+    Query the database like query_table, but yield the result as DataFrames of at most `batch_size` rows
+    so that the memory use does not depend on the size of the result
 
-    df = pd.read_sql_query(f"""
-        SELECT {', '.join(columns)}
-        FROM {table_name}
-        WHERE {where_clause}
-        """, conn)
+    :param batch_size: the number of rows per DataFrame
+    '''
+    return connect(sql_database).iter_table(table_name, columns, start_date, end_date, fips, batch_size)
 
-    conn.close()
+def arrow_type(declared):
+    '''
+    The Arrow type of a column declared with a SQLite type (by SQLite's affinity rules) or already an Arrow type
+    '''
+    if isinstance(declared, pa.DataType):
+        return declared
+    declared = declared.upper()
+    if 'INT' in declared:
+        return pa.int64()
+    if any(name in declared for name in ('REAL', 'FLOA', 'DOUB')):
+        return pa.float64()
+    return pa.string()
+
+def export_table(sql_database, table_name, columns, start_date, end_date, output_file, fips=None, batch_size=100000):
+    '''
+    Stream a query (see query_table) to a CSV file, or a Parquet file if the name ends with .parquet (requires pyarrow),
+    one batch at a time: the whole result is never held in memory
 
-    return df
+    :param output_file: the file to write, replaced if it exists
+    :param batch_size: the number of rows per batch
+    :return: the number of rows written
+    '''
+    parquet = os.path.splitext(output_file)[1].lower() == '.parquet'
+    if parquet and pa is None:
+        raise ImportError("Parquet output requires pyarrow. Try `pip install pyarrow`.")
+
+    rows = 0
+    writer = None
+    schema = None
+    try:
+        for batch in iter_table(sql_database, table_name, columns, start_date, end_date, fips, batch_size):
+            if parquet:
+                if writer is None:
+                    # a column with no value in the first batch is inferred as type null, use its declared type instead
+                    declared = {name.lower(): column_type for name, column_type in connect(sql_database).column_types(table_name).items()}
+                    schema = pa.Schema.from_pandas(batch, preserve_index=False)
+                    schema = pa.schema([pa.field(field.name, arrow_type(declared.get(field.name.lower(), '')))
+                                        if pa.types.is_null(field.type) else field
+                                        for field in schema])
+                    writer = pq.ParquetWriter(output_file, schema)
+                writer.write_table(pa.Table.from_pandas(batch, schema=schema, preserve_index=False))
+            else:
+                batch.to_csv(output_file, mode='w' if rows == 0 else 'a', header=(rows == 0), index=False)
+            rows += len(batch)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if rows == 0: # still write an empty file, with the column names
+        empty = pd.DataFrame(columns=columns)
+        if parquet:
+            pq.write_table(pa.Table.from_pandas(empty, preserve_index=False), output_file)
+        else:
+            empty.to_csv(output_file, index=False)
+    return rows
 
 def get_unique_sites(sql_database, table_name):
     """
     for air quality data, we have latitude and longitude only
     
     """
-    conn = sqlite3.connect(sql_database)
-    
-    df = pd.read_sql_query(f"""
-        SELECT DISTINCT latitude, longitude
-        FROM {table_name}
-        """, conn)
-        
-    conn.close()
-    
-    return df
+    return connect(sql_database).get_unique_sites(table_name)
 
 def get_unique_fips(sql_database, table_name):
     """
     for air quality and census data, all tables have FIPS code
 
     """
-    conn = sqlite3.connect(sql_database)
-    
-    df = pd.read_sql_query(f"""
-        SELECT DISTINCT FIPS
-        FROM {table_name}
-        """, conn)
-        
-    conn.close()
-    
-    return df
+    return connect(sql_database).get_unique_fips(table_name)
 
+@query_cache.memoize()
 def get_county_fips(sql_database, table_name, state=None, state_column='state', county_column='county', fips_column='FIPS'):
 
     """
@@ -140,19 +780,29 @@ def get_county_fips(sql_database, table_name, state=None, state_column='state',
     :param table_name: the name of the table to query
     state is not implemented yet
     """ 
+    return connect(sql_database).get_county_fips(table_name, state, state_column, county_column, fips_column)
 
-    conn = sqlite3.connect(sql_database)
-
-    # Add a WHERE clause if a state is specified
-    where_clause = f"WHERE {state_column} = '{state}'" if state else ''
 
-    df_counties = pd.read_sql_query(f"SELECT DISTINCT {fips_column}, {county_column} FROM {table_name} {where_clause}", conn)
-    conn.close()
+### an essential function for evaluating the air quality
 
-    return df_counties
+def get_poorair_percentages(sql_database, table_name, thresholds, fips=None, start_date=None, end_date=None, max_error=None):
+    """
+    Calculate the percentage of measurements that exceed each of the given thresholds, for many counties at once;
+    a single GROUP BY FIPS query, with one conditional count per threshold.
 
+    :param sql_database: the name of the SQL database to query
+    :param table_name: the name of the table to query (air quality hourly sampelData only)
+    :param thresholds: a threshold, or a list of thresholds, for air quality measurements
+    :param fips: a FIPS code or a list of FIPS codes to query (optional, all counties if None)
+    :param start_date: the start date of the date range to query (either a year or a date in the format YYYY-MM-DD)
+    :param end_date: the end date of the date range to query (either a year or a date in the format YYYY-MM-DD)
+    :param max_error: accept estimates from the histogram of the table (see rollups.py) off by at most this fraction
+                      (e.g. 0.01 for one percentage point), for thresholds without an exact rollup (optional)
 
-### an essential function for evaluating the air quality
+    return a DataFrame with a row per FIPS code: total_count, then a `Percentage_<threshold>` column per threshold
+    counties without measurements in the date range are not in the result
+    """
+    return connect(sql_database).get_poorair_percentages(table_name, thresholds, fips, start_date, end_date, max_error)
 
 def get_poorair_percentage(sql_database, table_name, fips, threshold, start_date=None, end_date=None):
     """
@@ -167,41 +817,9 @@ def get_poorair_percentage(sql_database, table_name, fips, threshold, start_date
     :param end_date: the end date of the date range to query (either a year or a date in the format YYYY-MM-DD)
     
     """
-    conn = sqlite3.connect(sql_database)
+    return connect(sql_database).get_poorair_percentage(table_name, fips, threshold, start_date, end_date)
 
-    # Initialize the WHERE clause with the FIPS code
-    where_clause = f"FIPS = '{fips}'"
-
-    # If a date range is provided, add it to the WHERE clause
-    if start_date is not None and end_date is not None:
-        ## determine the format of the date -- if they are integers, then they are years
-        if isinstance(start_date, int) and isinstance(end_date, int):
-            where_clause += f" AND Year BETWEEN {start_date} AND {end_date}"
-        else:
-            where_clause += f" AND date_local BETWEEN '{start_date}' AND '{end_date}'"
-
-    # Query the total number of measurements and the number of measurements that exceed the threshold
-    df = pd.read_sql_query(f"""
-        SELECT 
-            COUNT(*) as total_count,
-            SUM(CASE WHEN sample_measurement > {threshold} THEN 1 ELSE 0 END) as threshold_count
-        FROM {table_name}
-        WHERE {where_clause}
-        """, conn)
-
-    conn.close()
-
-    # Calculate the percentage of measurements that exceed the threshold
-    if df['total_count'][0] == 0:
-        percentage = None  # No measurements were taken in the given date range
-        print(f"No measurements were taken in the given date range for FIPS code: {fips}")
-    else:
-        percentage = (df['threshold_count'][0] / df['total_count'][0]) * 100
-        print(f"Calculation done on FIPS code: {fips}")
-
-    return percentage
-
-## utilize get_poorair_percentage in a loop to get the percentage for all counties
+## compute the percentage for all counties with one grouped query
 def air_threshold_percentages(df_counties, sql_database, table_name, threshold, begin_year=2009, end_year=2021):
     """
     Calculate the percentage of measurements that exceed the given threshold for all counties;
@@ -217,22 +835,17 @@ def air_threshold_percentages(df_counties, sql_database, table_name, threshold,
     e.g. df_counties = get_county_fips(sql_database, table_name) -- this will return all counties in the database
     
     """
-    
-    percentages = []
-    for fips, county in df_counties.values:
-        percentage = get_poorair_percentage(sql_database, table_name, fips, threshold, begin_year, end_year)
-        percentages.append((fips, county, percentage))
-
-    # Create a DataFrame from the percentages data
-    df_percentages = pd.DataFrame(percentages, columns=['FIPS', 'County', 'Percentage'])
-    return df_percentages
+    return connect(sql_database).air_threshold_percentages(df_counties, table_name, threshold, begin_year, end_year)
 
 ## example to plot the above df_percentages
-def plot_air_quality(df, geojson_file='geojson-counties-fips.json'):
+def plot_air_quality(df, geojson_file=None):
 
-    # Load GeoJSON file
-    with open(geojson_file) as response:
-        counties = json.load(response)
+    # Load GeoJSON file, by default only the counties of df from the cached geometry (see geometry.py)
+    if geojson_file is None:
+        counties = geometry.county_geometry(df['FIPS'])
+    else:
+        with open(geojson_file) as response:
+            counties = json.load(response)
 
     # Define function to plot choropleth map
     fig = px.choropleth(df, geojson=counties, locations= 'FIPS', color='Percentage',
@@ -0,0 +1,140 @@
+import os
+import json
+import threading
+import numpy as np
+
+'''
+County geometry for the choropleth maps
+
+The national county GeoJSON is read once, on first use, from the json folder next to this file.
+Maps only embed the counties they plot (see county_geometry), optionally simplified with the
+Douglas-Peucker algorithm: each tolerance in `tolerances` is computed once and cached on disk,
+in `cache_dir`, so later runs load the simplified file directly.
+'''
+
+geojson_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'json', 'geojson-counties-fips.json')
+cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'geometry_cache')
+
+## the simplification tolerances offered, in degrees (0.001 is about 100 m); 0 keeps the original geometry
+tolerances = (0, 0.001, 0.005, 0.01)
+
+## the tolerance used by the maps of the project, well below what a state-wide map can show
+map_tolerance = 0.005
+
+_geometries = {} # tolerance -> GeoJSON FeatureCollection
+_lock = threading.Lock()
+
+
+def simplify_line(points, tolerance):
+    '''
+    Douglas-Peucker simplification of a line
+
+    :param points: an (n, 2) numpy array of coordinates
+    :param tolerance: the largest distance allowed between the line and its simplification
+    :return: a boolean mask of the points to keep, the end points are always kept
+    '''
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+
+        # distances of the points between start and end to the segment (or to start if the segment is a point)
+        segment = points[end] - points[start]
+        offsets = points[start + 1:end] - points[start]
+        length = np.hypot(*segment)
+        if length == 0:
+            distances = np.hypot(offsets[:, 0], offsets[:, 1])
+        else:
+            distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            index = start + 1 + farthest
+            keep[index] = True
+            stack.append((start, index))
+            stack.append((index, end))
+
+    return keep
+
+def simplify_ring(ring, tolerance):
+    '''
+    Simplify a closed polygon ring, keeping it a valid ring (at least 4 positions, first equals last)
+    '''
+    points = np.asarray(ring, dtype=float)
+    if len(points) <= 4:
+        return ring
+
+    # a closed ring starts and ends on the same point: split it at the point farthest from the start
+    split = int(np.argmax(np.hypot(*(points - points[0]).T)))
+    keep = np.concatenate([simplify_line(points[:split + 1], tolerance)[:-1], simplify_line(points[split:], tolerance)])
+
+    if keep.sum() < 4:
+        return ring
+    return np.round(points[keep], 5).tolist()
+
+def simplify_geometry(geometry, tolerance):
+    if geometry['type'] == 'Polygon':
+        return {'type': 'Polygon', 'coordinates': [simplify_ring(ring, tolerance) for ring in geometry['coordinates']]}
+    if geometry['type'] == 'MultiPolygon':
+        return {'type': 'MultiPolygon',
+                'coordinates': [[simplify_ring(ring, tolerance) for ring in polygon] for polygon in geometry['coordinates']]}
+    return geometry
+
+
+def load_counties(tolerance=0):
+    '''
+    Return the national county GeoJSON, simplified to a tolerance from `tolerances`
+    (loaded once per process, and computed once per tolerance then cached on disk)
+    '''
+    if tolerance not in tolerances:
+        raise ValueError(f"Unknown tolerance {tolerance}, choose from {tolerances}")
+
+    with _lock:
+        if tolerance in _geometries:
+            return _geometries[tolerance]
+
+        if tolerance == 0:
+            with open(geojson_file, 'r') as file:
+                geometry = json.load(file)
+        else:
+            cache_file = os.path.join(cache_dir, f'geojson-counties-fips-{tolerance:g}.json')
+            if os.path.exists(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(geojson_file):
+                with open(cache_file, 'r') as file:
+                    geometry = json.load(file)
+            else:
+                geometry = None
+
+    if geometry is None:
+        original = load_counties(0)
+        geometry = {'type': original['type'],
+                    'features': [{'type': 'Feature', 'id': feature['id'], 'properties': feature['properties'],
+                                  'geometry': simplify_geometry(feature['geometry'], tolerance)}
+                                 for feature in original['features']]}
+
+        os.makedirs(cache_dir, exist_ok=True)
+        temp_file = cache_file + '.tmp'
+        with open(temp_file, 'w') as file:
+            json.dump(geometry, file, separators=(',', ':'))
+        os.replace(temp_file, cache_file)
+
+    with _lock:
+        _geometries[tolerance] = geometry
+    return geometry
+
+def county_geometry(fips_codes=None, tolerance=map_tolerance):
+    '''
+    Return a GeoJSON FeatureCollection with only the counties plotted
+
+    :param fips_codes: the FIPS codes of the counties (e.g. the locations column of a choropleth), all counties if None
+    :param tolerance: the simplification tolerance, one of `tolerances`
+    '''
+    counties = load_counties(tolerance)
+    if fips_codes is None:
+        return counties
+
+    wanted = {str(code).zfill(5) for code in fips_codes}
+    return {'type': counties['type'], 'features': [feature for feature in counties['features'] if feature['id'] in wanted]}
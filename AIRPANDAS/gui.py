@@ -3,6 +3,7 @@ import aqs_request
 import census_request
 import database_query as dbq
 import visualization as viz
+from response_cache import ResponseCache
 import textwrap
 
 class AqsGUI:
@@ -24,6 +25,7 @@ class AqsGUI:
         for param, description in self.param_descriptions.items():
             self.param_descriptions[param] = textwrap.fill(description, width=50)
         self.dataframe = None
+        self.cache = ResponseCache() ## repeated requests are served from disk
 
         # Create the window with the defined layout
         self.window = sg.Window("EPA AQS Data Retrieval", self.layout)
@@ -107,10 +109,11 @@ class AqsGUI:
                                 break
                             elif event_params == "Submit Parameters":
                                 params = aqs_request.complete_params(aqs_request.get_params(goal), values_params)
-                                self.dataframe = aqs_request.execute_query_strategy(goal, params)
+                                self.dataframe = aqs_request.execute_query_strategy(goal, params, self.cache)
                                 ## allow user to save and show data when data is retrieved
-                                self.window['Save Data'].update(disabled=False)
-                                self.window['Show Data'].update(disabled=False)                                  
+                                ## (large requests are streamed to a file and leave no dataframe)
+                                self.window['Save Data'].update(disabled=self.dataframe is None)
+                                self.window['Show Data'].update(disabled=self.dataframe is None)
                             elif event_params.startswith("Help_"):
                                 param = event_params.split("_")[1]
                                 self._handle_help(param)
@@ -134,6 +137,7 @@ class CensusGUI:
         self.api_key = census_request.get_api_key()
         self.category_code_dict = census_request.read_json('AIRPANDAS\json\category_code.json')
         self.year_category_abbrev_dict = census_request.read_json('AIRPANDAS\json\year_category_abbrev.json')
+        self.cache = ResponseCache()
         self.categories = set()
 
         for year in self.year_category_abbrev_dict:
@@ -161,7 +165,7 @@ class CensusGUI:
                 
                 if category and year:
                     try:
-                        census_request.query_census_data(int(year), int(year), category)
+                        census_request.query_census_data(int(year), int(year), category, self.cache)
                         sg.popup('Data successfully retrieved and saved as CSV')
                     except Exception as e:
                         sg.popup_error(f"Error: {str(e)}")
@@ -276,13 +280,14 @@ class dbGUI:
                                 start_date = values['-START_DATE-']
                                 end_date = values['-END_DATE-']
                                 fips = values['-FIPS-'] if values['-FIPS-'] else None
-                                df = dbq.query_table(self.database, table_name, selected_columns, start_date, end_date, fips)
+                                output_file = f'{table_name}_{start_date}_{end_date}.csv'
+
+                                # streamed to the file batch by batch, a large query never sits in memory
+                                rows = dbq.export_table(self.database, table_name, selected_columns, start_date, end_date, output_file, fips)
                                 
                                 sg.popup_animated(None)
 
-                                print("dataframe:",df.head())
-                                df.to_csv(f'{table_name}_{start_date}_{end_date}.csv')
-                                sg.popup(f'Data successfully retrieved and saved as {table_name}_{start_date}_{end_date}.csv')
+                                sg.popup(f'{rows} rows successfully retrieved and saved as {output_file}')
                                 
                         date_window.close()
 
@@ -341,8 +346,8 @@ class dbGUI:
                                 year = int(values['-YEAR-'])
                                 threshold = float(values['-THRESHOLD-'])
 
-                                # create the plot
-                                fig, _ = viz.create_side_comparison(threshold, year, table_name, selected_columns)
+                                # create the plot, proportions within one percentage point are precise enough for a map
+                                fig = viz.create_side_comparison(threshold, year, table_name, selected_columns, max_error=0.01, sql_database=self.database)
                                 fig.write_html(f"{table_name}_comparison_{year}.html")
 
                                 # stop loading gif
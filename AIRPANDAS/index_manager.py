@@ -0,0 +1,169 @@
+import pandas as pd
+import database_query as dbq
+
+'''
+Index management for the AirPandas database
+
+The indexes below are derived from how the rest of the project reads the database:
+- query_table on PM25, by FIPS code and date range (optionally all counties for a date range)
+- get_poorair_percentages / air_threshold_percentages, by year or date range, grouped by FIPS
+- visualization.calc_proportion, one year grouped by FIPS, with the county name
+- census tables, by Year and FIPS (query_table, visualization.data_census)
+
+ensure_indexes() creates the missing ones and runs ANALYZE so the query planner has statistics;
+index_report() runs EXPLAIN QUERY PLAN on each access pattern to show which index it uses.
+database_creator.py calls both at the end of the database creation.
+'''
+
+## (table, columns, access pattern) -- the column order matters: equality filters first, then ranges,
+## then the columns read by the query so the index covers it and the table is never touched
+pm25_indexes = [
+    ("PM25", ["FIPS", "date_local", "sample_measurement"], "PM25 by FIPS and date range (query_table, get_poorair_percentages)"),
+    ("PM25", ["year", "FIPS", "sample_measurement", "county"], "PM25 by year, grouped by FIPS (calc_proportion, air_threshold_percentages)"),
+    ("PM25", ["date_local", "FIPS"], "PM25 by date range for all counties (query_table)"),
+]
+
+## the same access patterns on the compact layout (see compact_schema.py), on the integer columns of the fact table
+compact_indexes = [
+    ("PM25_fact", ["fips", "epoch_day", "sample_measurement"], "PM25 by FIPS and date range (query_table, get_poorair_percentages)"),
+    ("PM25_fact", ["year", "fips", "sample_measurement"], "PM25 by year, grouped by FIPS (calc_proportion, air_threshold_percentages)"),
+    ("PM25_fact", ["epoch_day", "fips"], "PM25 by date range for all counties (query_table)"),
+]
+
+census_index_columns = ["Year", "FIPS"]
+
+## the rollups and histogram of PM25 (see rollups.py) are clustered on their primary keys, they need no index
+rollup_tables = (dbq.rollup_table("PM25", "daily"), dbq.rollup_table("PM25", "annual"),
+                 dbq.histogram_table("PM25"), "histogram_settings")
+
+
+def plan_indexes(sql_database):
+    '''
+    List the indexes the access patterns need, for the tables and columns present in the database
+
+    :param sql_database: the name of the SQL database
+    :return: a list of (table, columns, access pattern) tuples
+    '''
+    database = dbq.connect(sql_database)
+    database.refresh_schema()
+    schema = database.schema()
+
+    def has_columns(table, columns):
+        table_columns = [column.lower() for column in schema.get(table, [])]
+        return all(column.lower() in table_columns for column in columns)
+
+    # views cannot be indexed, the compact layout's PM25 view is indexed through its fact table
+    conn = database.connection()
+    views = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='view'")}
+
+    plan = [index for index in pm25_indexes + compact_indexes
+            if index[0] not in views and has_columns(index[0], index[1])]
+
+    # every other table with Year and FIPS is a census table
+    for table in schema:
+        if table not in ("PM25", "PM25_fact") + rollup_tables and table not in views and has_columns(table, census_index_columns):
+            plan.append((table, census_index_columns, f"{table} by Year and FIPS (query_table, data_census)"))
+
+    return plan
+
+def existing_indexes(sql_database):
+    '''
+    Return the names of the indexes already in the database
+    '''
+    conn = dbq.connect(sql_database).connection()
+    return [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='index' AND name NOT LIKE 'sqlite_%'")]
+
+def ensure_indexes(sql_database, analyze=True):
+    '''
+    Create the indexes the access patterns need (see plan_indexes), then run ANALYZE
+
+    :param sql_database: the name of the SQL database
+    :param analyze: gather planner statistics once the indexes exist
+    :return: the names of the indexes created
+    '''
+    database = dbq.connect(sql_database)
+    before = set(existing_indexes(sql_database))
+
+    for table, columns, pattern in plan_indexes(sql_database):
+        print(f"Indexing {table} ({', '.join(columns)}) for {pattern}")
+        database.create_index(table, columns)
+
+    if analyze:
+        conn = database.write_connection()
+        conn.execute("ANALYZE")
+        conn.commit()
+
+    return [name for name in existing_indexes(sql_database) if name not in before]
+
+def explain_query_plan(sql_database, sql, params=()):
+    '''
+    Return the steps of EXPLAIN QUERY PLAN for a statement, as a list of strings
+    '''
+    # a fresh connection: a cached EXPLAIN statement never notices new indexes, it does not read the schema cookie
+    database = dbq.Database(sql_database)
+    try:
+        return [row[-1] for row in database.connection().execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+    finally:
+        database.close()
+
+def sample_queries(sql_database):
+    '''
+    One representative statement per access pattern, built from the data in the database
+
+    :return: a list of (access pattern, sql, params) tuples
+    '''
+    database = dbq.connect(sql_database)
+    builder = database.query_builder()
+    conn = database.connection()
+    queries = []
+
+    if "PM25" in database.schema():
+        fips, year = conn.execute("SELECT FIPS, year FROM PM25 LIMIT 1").fetchone()
+        start_date, end_date = f"{year}-01-01", f"{year}-12-31"
+
+        sql, params = builder.select("PM25", ["date_local", "sample_measurement"], start_date, end_date, fips)
+        queries.append(("query_table by FIPS and date", sql, params))
+
+        sql, params = builder.select("PM25", ["FIPS", "sample_measurement"], start_date, end_date)
+        queries.append(("query_table by date", sql, params))
+
+        conditions, params = builder.conditions("PM25", year, year)
+        queries.append(("get_poorair_percentages by year",
+                        f"SELECT FIPS, COUNT(*), SUM(CASE WHEN sample_measurement > ? THEN 1 ELSE 0 END) FROM PM25 WHERE {' AND '.join(conditions)} GROUP BY FIPS",
+                        [35] + params))
+
+        queries.append(("calc_proportion",
+                        "SELECT FIPS, SUM(CASE WHEN sample_measurement >= ? THEN 1 ELSE 0 END), COUNT(*), MIN(county) FROM PM25 WHERE year = ? GROUP BY FIPS",
+                        [35, year]))
+
+    for table, columns, pattern in plan_indexes(sql_database):
+        if columns == census_index_columns:
+            year = conn.execute(f'SELECT Year FROM "{table}" LIMIT 1').fetchone()
+            if year is not None:
+                sql, params = builder.select(table, ["FIPS"], year[0], year[0])
+                queries.append((f"{table} by year", sql, params))
+
+    return queries
+
+def index_report(sql_database):
+    '''
+    Run EXPLAIN QUERY PLAN on every access pattern and report how each one reads the data
+
+    :return: a DataFrame with the access pattern, the plan, and whether an index is used
+    '''
+    rows = []
+    for pattern, sql, params in sample_queries(sql_database):
+        plan = explain_query_plan(sql_database, sql, params)
+        uses_index = any("USING" in step and "INDEX" in step for step in plan)
+        rows.append((pattern, " | ".join(plan), uses_index))
+
+    return pd.DataFrame(rows, columns=["pattern", "plan", "uses_index"])
+
+
+def main():
+    sql_database = 'airpandas_1.sqlite'
+    print("Created:", ensure_indexes(sql_database))
+    print(index_report(sql_database).to_string())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+import os
+import json
+import pickle
+import hashlib
+import inspect
+import threading
+import functools
+from collections import OrderedDict
+
+'''
+A memoization layer for query results, used by database_query.py and visualization.py
+
+A result is stored under a hash of the function, its normalized arguments, the database path and the
+database's data version: the modification time and size of the SQLite file and its WAL (or of every file
+of a Parquet dataset folder). Loading data into the database changes the version, so results computed
+before are never served again: ingestion invalidates the cache without being aware of it.
+
+- The most recently used results are kept in memory, up to `max_entries`.
+- With a `spill_dir`, results evicted from memory are pickled to disk (up to `max_spill_bytes`) and
+  read back on the next request instead of querying the database again.
+'''
+
+
+def data_version(sql_database):
+    '''
+    A value that changes whenever the data of the database changes
+
+    :param sql_database: a SQLite file, or a folder of Parquet datasets
+    '''
+    if os.path.isdir(sql_database):
+        version = []
+        for root, _, files in os.walk(sql_database):
+            for name in files:
+                stat = os.stat(os.path.join(root, name))
+                version.append((os.path.relpath(os.path.join(root, name), sql_database), stat.st_mtime_ns, stat.st_size))
+        return sorted(version)
+
+    version = []
+    for suffix in ("", "-wal"): # a commit in WAL mode only touches the -wal file until the checkpoint
+        try:
+            stat = os.stat(sql_database + suffix)
+            version.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            version.append(None)
+    return version
+
+
+def normalize(value):
+    '''
+    Turn an argument into plain JSON values, in full: numpy arrays, pandas Series and numpy scalars
+    through tolist(), lists and tuples item by item, sets sorted, dictionaries by key
+
+    :raises TypeError: for any other object, its repr could be truncated or not identify its value
+    '''
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if hasattr(value, "tolist"):
+        return normalize(value.tolist())
+    if isinstance(value, (list, tuple)):
+        return [normalize(item) for item in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted((normalize(item) for item in value), key=json.dumps)
+    if isinstance(value, dict):
+        return {str(key): normalize(item) for key, item in value.items()}
+    raise TypeError(f"Cannot build a cache key from a {type(value).__name__}")
+
+
+class QueryCache:
+    '''
+    In-memory LRU cache of query results, with an optional on-disk spill
+
+    :param max_entries: the number of results kept in memory
+    :param spill_dir: the folder for the results evicted from memory (optional, evicted results are dropped without it)
+    :param max_spill_bytes: the size cap of the spill folder, in bytes
+    '''
+    def __init__(self, max_entries=128, spill_dir=None, max_spill_bytes=256 * 1024 ** 2):
+        self.max_entries = max_entries
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.spill_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(name, sql_database, arguments):
+        '''
+        Hash the function name, the database and its data version, and the normalized arguments
+
+        :param arguments: a {name: value} dictionary of the call arguments, defaults applied
+        :raises TypeError: if an argument cannot be normalized (see normalize), the call must not be cached
+        '''
+        payload = json.dumps([name, os.path.abspath(sql_database), data_version(sql_database), normalize(arguments)],
+                             sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _spill_path(self, key):
+        return os.path.join(self.spill_dir, f"{key}.pkl")
+
+    def get(self, key):
+        '''
+        Return (True, result) on a hit, from memory or from the spill folder, (False, None) on a miss
+        '''
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, self.entries[key]
+
+            if self.spill_dir is not None and os.path.exists(self._spill_path(key)):
+                with open(self._spill_path(key), "rb") as file:
+                    value = pickle.load(file)
+                os.remove(self._spill_path(key))
+                self.spill_hits += 1
+                self._store(key, value)
+                return True, value
+
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        with self.lock:
+            self._store(key, value)
+
+    def _store(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            evicted_key, evicted = self.entries.popitem(last=False)
+            self.evictions += 1
+            if self.spill_dir is not None:
+                self._spill(evicted_key, evicted)
+
+    def _spill(self, key, value):
+        with open(self._spill_path(key), "wb") as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # drop the oldest spilled results beyond the size cap
+        files = [os.path.join(self.spill_dir, name) for name in os.listdir(self.spill_dir) if name.endswith(".pkl")]
+        files.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in files)
+        for path in files:
+            if total <= self.max_spill_bytes:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+    def stats(self):
+        '''
+        Return hit/miss statistics of the cache, as a dictionary
+        '''
+        lookups = self.hits + self.spill_hits + self.misses
+        return {
+            "hits": self.hits,
+            "spill_hits": self.spill_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.spill_hits) / lookups if lookups else None,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+        }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            if self.spill_dir is not None:
+                for name in os.listdir(self.spill_dir):
+                    if name.endswith(".pkl"):
+                        os.remove(os.path.join(self.spill_dir, name))
+
+
+## the cache shared by the memoized functions, replace it to change the size or to spill to disk
+default_cache = QueryCache()
+
+
+def memoize(database_argument="sql_database"):
+    '''
+    Decorator caching the results of a query function in `default_cache`
+
+    :param database_argument: the name of the function argument holding the database path
+    '''
+    def decorator(function):
+        signature = inspect.signature(function)
+        name = f"{function.__module__}.{function.__qualname__}"
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+            try:
+                key = QueryCache.make_key(name, arguments.pop(database_argument), arguments)
+            except TypeError: # an argument without a reliable key: run the query, do not cache it
+                return function(*args, **kwargs)
+
+            # copies in and out: a caller modifying its DataFrame must not modify the cached one
+            found, value = default_cache.get(key)
+            if not found:
+                value = function(*args, **kwargs)
+                default_cache.put(key, value.copy() if hasattr(value, "copy") else value)
+                return value
+            return value.copy() if hasattr(value, "copy") else value
+
+        return wrapper
+    return decorator
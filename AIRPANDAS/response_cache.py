@@ -0,0 +1,183 @@
+import sqlite3
+import hashlib
+import json
+import threading
+import time
+import os
+from datetime import datetime, timedelta
+
+'''
+An on-disk cache for API responses, shared by aqs_request.py and census_request.py
+
+Responses are stored in a small SQLite file, addressed by a hash of the endpoint plus the
+normalized request parameters (credentials removed, so the same request made with a different
+API key is still a hit).
+
+- Closed historical periods (e.g. a quarter of AQS data from years ago, a released ACS5 year)
+  never change, they are kept forever.
+- Recent periods may still be revised, they expire after `recent_ttl` seconds.
+- The total size is capped; the least recently used responses are evicted first.
+'''
+
+CREDENTIAL_PARAMS = ("email", "key")
+
+
+class CachedResponse:
+    '''
+    Stand-in for a requests.Response served from the cache
+    Only what the request modules use: status_code, text, url and json()
+    '''
+    def __init__(self, url, status_code, text):
+        self.url = url
+        self.status_code = status_code
+        self.text = text
+        self.from_cache = True
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class ResponseCache:
+    '''
+    Content-addressed response cache with TTL policy, size cap and LRU eviction
+
+    :param cache_dir: the folder holding the cache database
+    :param max_bytes: the size cap for all stored responses, in bytes
+    :param recent_ttl: seconds before a response for a recent (still open) period expires
+    :param settle_days: days after its end date before a period is considered closed
+    '''
+    def __init__(self, cache_dir="api_cache", max_bytes=1024 ** 3, recent_ttl=24 * 3600, settle_days=365):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.recent_ttl = recent_ttl
+        self.settle_days = settle_days
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(cache_dir, "responses.sqlite"), check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                url TEXT,
+                status_code INTEGER,
+                body TEXT,
+                size INTEGER,
+                created REAL,
+                expires REAL,
+                last_access REAL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)")
+        self.conn.commit()
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(url, params):
+        '''
+        Hash the endpoint and the normalized parameters, leaving the credentials out
+
+        :param url: the endpoint url (without query string)
+        :param params: a dictionary of request parameters
+        :return: a hex digest identifying the request
+        '''
+        normalized = {str(k): str(v) for k, v in params.items() if k not in CREDENTIAL_PARAMS}
+        payload = json.dumps([url, normalized], sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def ttl_for(self, period_end):
+        '''
+        TTL policy: None (keep forever) for a closed period, `recent_ttl` otherwise
+
+        :param period_end: the last date covered by the request, a datetime; None if unknown
+        '''
+        if period_end is not None and period_end + timedelta(days=self.settle_days) < datetime.now():
+            return None
+        return self.recent_ttl
+
+    def get(self, url, params):
+        '''
+        Look up a response; return a CachedResponse, or None on a miss or an expired entry
+        '''
+        key = self.make_key(url, params)
+        now = time.time()
+
+        with self.lock:
+            row = self.conn.execute("SELECT url, status_code, body, expires FROM responses WHERE key = ?", (key,)).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            cached_url, status_code, body, expires = row
+            if expires is not None and expires < now:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.conn.commit()
+                self.expired += 1
+                self.misses += 1
+                return None
+
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self.hits += 1
+
+        return CachedResponse(cached_url, status_code, body)
+
+    def put(self, url, params, response, ttl=None):
+        '''
+        Store a successful response, then evict least recently used ones beyond the size cap
+
+        :param response: a requests.Response (only status 200 is cached)
+        :param ttl: seconds to keep the response, None to keep it forever (see ttl_for)
+        '''
+        if response.status_code != 200:
+            return
+
+        key = self.make_key(url, params)
+        body = response.text
+        size = len(body.encode("utf-8"))
+        now = time.time()
+        expires = None if ttl is None else now + ttl
+
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              (key, url, response.status_code, body, size, now, expires, now))
+            self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        # drop the least recently used responses until the total size fits the cap
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            self.evictions += 1
+
+    def stats(self):
+        '''
+        Return hit/miss statistics and the current size of the cache, as a dictionary
+        '''
+        with self.lock:
+            entries, total = self.conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else None,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "entries": entries,
+            "bytes": total,
+        }
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM responses")
+            self.conn.commit()
@@ -0,0 +1,254 @@
+import database_query as dbq
+
+'''
+Pre-aggregated rollups of the PM25 measurements, by county-day and by county-year
+
+    PM25_daily  (date_local, FIPS, year, month, county, count, sum, min, max, gt_12, ge_12, ...)
+    PM25_annual (year, FIPS, county, count, sum, min, max, gt_12, ge_12, ...)
+
+For each threshold in `rollup_thresholds`, gt_<t> counts the measurements above it and ge_<t> the
+measurements at or above it (get_poorair_percentages uses >, visualization.calc_proportion uses >=).
+
+The query functions use a rollup whenever it can answer the query (see database_query.Database.rollup_for):
+whole years are read from the annual rollup, whole days from the daily one, and the raw table is only
+scanned for thresholds that are not pre-counted. database_creator.py builds the rollups after loading the
+data; once they exist, every loader recomputes the days (and years) it loaded (see refresh_after_load).
+
+For any other threshold, a histogram of the measurements by county and year (or month) answers the share
+of measurements above it from cumulative bins:
+
+    PM25_histogram (year, month, FIPS, bin, count) -- bin k holds the measurements in [k * bin_width, (k + 1) * bin_width)
+
+Only the bin holding the threshold is uncertain, so the error of an exceedance fraction is at most the share
+of measurements in that bin; it is reported with the estimate and shrinks with bin_width (see
+database_query.Database.histogram_exceedance). month is 0 in a histogram by year.
+'''
+
+## the standard PM2.5 thresholds (µg/m³): the annual and daily standards, and the visualization levels
+rollup_thresholds = [12, 15, 30, 35]
+
+
+def threshold_columns():
+    '''
+    The threshold count columns of a rollup, as (name, sql operator, threshold) tuples
+    '''
+    return [(dbq.threshold_column(op, threshold), operator, threshold)
+            for threshold in rollup_thresholds
+            for op, operator in (("gt", ">"), ("ge", ">="))]
+
+def create_rollup_tables(conn, table_name):
+    counts = "".join(f", {name} INTEGER" for name, _, _ in threshold_columns())
+    daily, annual = dbq.rollup_table(table_name, "daily"), dbq.rollup_table(table_name, "annual")
+
+    # clustered on the date (year) first: the queries filter on a date range and group by FIPS
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS "{daily}" (
+            date_local TEXT, FIPS TEXT, year INTEGER, month INTEGER, county TEXT,
+            count INTEGER, sum REAL, min REAL, max REAL{counts},
+            PRIMARY KEY (date_local, FIPS)
+        ) WITHOUT ROWID''')
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS "{annual}" (
+            year INTEGER, FIPS TEXT, county TEXT,
+            count INTEGER, sum REAL, min REAL, max REAL{counts},
+            PRIMARY KEY (year, FIPS)
+        ) WITHOUT ROWID''')
+
+def refresh_rollups(sql_database, table_name='PM25', start_date=None, end_date=None):
+    '''
+    Build the rollups of a measurement table, or recompute them for a date range only
+    (the days of the range, then every year the range touches)
+
+    :param sql_database: the name of the SQL database
+    :param table_name: the measurement table (or compact layout view)
+    :param start_date: the first day to recompute, YYYY-MM-DD (optional, all the data by default)
+    :param end_date: the last day to recompute, YYYY-MM-DD (inclusive)
+    :return: the number of (daily, annual) rollup rows written
+    '''
+    database = dbq.connect(sql_database)
+    database.refresh_schema()
+    builder = database.query_builder()
+    daily, annual = dbq.rollup_table(table_name, "daily"), dbq.rollup_table(table_name, "annual")
+
+    conditions, params = [], []
+    if start_date is not None and end_date is not None:
+        conditions, params = builder.conditions(table_name, str(start_date)[:10], str(end_date)[:10])
+    where_clause = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    measurement = f'"{builder.column(table_name, "sample_measurement")}"'
+    counts = "".join(f", SUM({measurement} {operator} {threshold})" for _, operator, threshold in threshold_columns())
+    sums = "".join(f", SUM({name})" for name, _, _ in threshold_columns())
+
+    conn = database.write_connection()
+    with conn: # one transaction
+        create_rollup_tables(conn, table_name)
+
+        if conditions:
+            conn.execute(f'DELETE FROM "{daily}" WHERE date_local BETWEEN ? AND ?', (str(start_date)[:10], str(end_date)[:10]))
+        else:
+            conn.execute(f'DELETE FROM "{daily}"')
+
+        daily_rows = conn.execute(f'''
+            INSERT INTO "{daily}"
+            SELECT substr(date_local, 1, 10), FIPS, MIN(year), MIN(month), MIN(county),
+                   COUNT(*), SUM({measurement}), MIN({measurement}), MAX({measurement}){counts}
+            FROM "{table_name}"
+            {where_clause}
+            GROUP BY substr(date_local, 1, 10), FIPS''', params).rowcount
+
+        # the annual rollup is summed from the daily one, for the years touched
+        if conditions:
+            years = [int(str(start_date)[:4]), int(str(end_date)[:4])]
+            conn.execute(f'DELETE FROM "{annual}" WHERE year BETWEEN ? AND ?', years)
+            year_clause = "WHERE year BETWEEN ? AND ?"
+        else:
+            conn.execute(f'DELETE FROM "{annual}"')
+            years, year_clause = [], ""
+
+        annual_rows = conn.execute(f'''
+            INSERT INTO "{annual}"
+            SELECT year, FIPS, MIN(county), SUM(count), SUM(sum), MIN(min), MAX(max){sums}
+            FROM "{daily}"
+            {year_clause}
+            GROUP BY year, FIPS''', years).rowcount
+
+        # rebuild the years of an existing histogram the same way
+        settings = histogram_settings(conn, table_name)
+
+    if settings is not None:
+        bin_width, granularity = settings
+        if conditions:
+            build_histograms(sql_database, table_name, bin_width, granularity, str(start_date)[:4], str(end_date)[:4])
+        else:
+            build_histograms(sql_database, table_name, bin_width, granularity)
+
+    database.refresh_schema()
+    return daily_rows, annual_rows
+
+def create_histogram_tables(conn, table_name):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS histogram_settings (
+            table_name TEXT PRIMARY KEY,
+            bin_width REAL,
+            granularity TEXT
+        )''')
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS "{dbq.histogram_table(table_name)}" (
+            year INTEGER, month INTEGER, FIPS TEXT, bin INTEGER, count INTEGER,
+            PRIMARY KEY (year, month, FIPS, bin)
+        ) WITHOUT ROWID''')
+
+def histogram_settings(conn, table_name):
+    '''
+    Return the (bin_width, granularity) of the histogram of a table, or None if it has none
+    '''
+    create_histogram_tables(conn, table_name)
+    return conn.execute("SELECT bin_width, granularity FROM histogram_settings WHERE table_name = ?", (table_name,)).fetchone()
+
+def build_histograms(sql_database, table_name='PM25', bin_width=0.5, granularity='year', start_year=None, end_year=None):
+    '''
+    Build the histogram of the measurements by county and year (or month), or rebuild some years of it
+
+    :param sql_database: the name of the SQL database
+    :param table_name: the measurement table (or compact layout view)
+    :param bin_width: the width of the bins in µg/m³; the smaller, the smaller the error bound of the estimates
+    :param granularity: "year" or "month"
+    :param start_year: the first year to rebuild (optional, all the data by default)
+    :param end_year: the last year to rebuild (inclusive)
+    :return: the number of histogram rows written
+    '''
+    if granularity not in ("year", "month"):
+        raise ValueError(f"Unknown granularity: {granularity}")
+
+    database = dbq.connect(sql_database)
+    database.refresh_schema()
+    builder = database.query_builder()
+    histogram = dbq.histogram_table(table_name)
+
+    measurement = f'"{builder.column(table_name, "sample_measurement")}"'
+    partial = start_year is not None and end_year is not None
+
+    conditions, params = [], []
+    if partial:
+        conditions, params = builder.conditions(table_name, int(start_year), int(end_year))
+    where_clause = " AND ".join(conditions + [f"{measurement} IS NOT NULL"])
+
+    # floor(measurement / bin_width), with a small nudge so 12.0 / 0.1 lands in bin 120 and not 119
+    scaled = f'({measurement} / {float(bin_width)!r} + 1e-9)'
+    bin_sql = f"(CAST({scaled} AS INTEGER) - ({scaled} < CAST({scaled} AS INTEGER)))"
+    month_sql = "month" if granularity == "month" else "0"
+
+    conn = database.write_connection()
+    with conn: # one transaction
+        settings = histogram_settings(conn, table_name)
+        if settings is not None and tuple(settings) != (float(bin_width), granularity) and partial:
+            raise ValueError(f"The histogram of {table_name} has bins of {settings[0]} by {settings[1]}, rebuild all of it")
+
+        if partial:
+            conn.execute(f'DELETE FROM "{histogram}" WHERE year BETWEEN ? AND ?', (int(start_year), int(end_year)))
+        else:
+            conn.execute(f'DELETE FROM "{histogram}"')
+        conn.execute("INSERT OR REPLACE INTO histogram_settings VALUES (?, ?, ?)", (table_name, float(bin_width), granularity))
+
+        rows = conn.execute(f'''
+            INSERT INTO "{histogram}"
+            SELECT year, {month_sql}, FIPS, {bin_sql}, COUNT(*)
+            FROM "{table_name}"
+            WHERE {where_clause}
+            GROUP BY year, {"month, " if granularity == "month" else ""}FIPS, {bin_sql}''', params).rowcount
+
+    database.refresh_schema()
+    return rows
+
+def has_rollups(sql_database, table_name='PM25'):
+    '''
+    Whether the rollups of a table exist
+    '''
+    database = dbq.connect(sql_database)
+    database.refresh_schema()
+    return dbq.rollup_table(table_name, "daily") in database.schema()
+
+def refresh_after_load(sql_database, table_name='PM25', start_date=None, end_date=None):
+    '''
+    Bring the rollups (and histogram) of a table up to date after a load, if the table has any,
+    so the query functions never read aggregates older than the data. Called by the loaders.
+
+    :param start_date: the first day loaded, YYYY-MM-DD (optional, all the data by default, e.g. after a replace)
+    :param end_date: the last day loaded (inclusive)
+    :return: the number of (daily, annual) rollup rows written, None if the table has no rollups
+    '''
+    if has_rollups(sql_database, table_name):
+        return refresh_rollups(sql_database, table_name, start_date, end_date)
+
+    # a histogram without rollups
+    database = dbq.connect(sql_database)
+    if "histogram_settings" in database.schema():
+        settings = histogram_settings(database.write_connection(), table_name)
+        if settings is not None:
+            bin_width, granularity = settings
+            if start_date is not None and end_date is not None:
+                build_histograms(sql_database, table_name, bin_width, granularity, str(start_date)[:4], str(end_date)[:4])
+            else:
+                build_histograms(sql_database, table_name, bin_width, granularity)
+    return None
+
+def build_rollups(sql_database, table_name='PM25'):
+    '''
+    Rebuild the daily and annual rollups of a measurement table from all its data
+    '''
+    print(f"Building the daily and annual rollups of {table_name}")
+    rows = refresh_rollups(sql_database, table_name)
+
+    conn = dbq.connect(sql_database).write_connection()
+    if histogram_settings(conn, table_name) is None:
+        print(f"Building the histogram of {table_name}")
+        build_histograms(sql_database, table_name)
+    return rows
+
+
+def main():
+    sql_database = 'airpandas_1.sqlite'
+    print(build_rollups(sql_database))
+
+if __name__ == '__main__':
+    main()
@@ -2,23 +2,40 @@
 import pandas as pd
 from sqlalchemy import create_engine
 
-import sqlite3
 import pandas as pd
 
+import os
+import re
+import plotly
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import pandas as pd
 import numpy as np
 import plotly.express as px
 import json
+from concurrent.futures import ProcessPoolExecutor
+import database_query as dbq
+import index_manager
+import query_cache
+import geometry
 
+# function to calculate proportion of times in a year there was a certan level of air quality
 
-with open('AIRPANDAS\json\geojson-counties-fips.json', 'r') as file:
-    counties = json.load(file)
+def level_threshold(level):
+    '''
+    returns the PM2.5 concentration (µg per cubic meter) of an air quality `level`, see calc_proportion
+    '''
+    if level == "moderate":
+        return 15
     
-# function to calculate proportion of times in a year there was a certan level of air quality
+    elif level == "unhealthy":
+        return 30
+    
+    else:
+        return level
 
-def calc_proportion(level, year):
+@query_cache.memoize()
+def calc_proportion(level, year, sql_database='airpandas_1.sqlite', max_error=None):
     '''
     calculates the proportion of air quality readings in each county that is above a certain `level` over the span of a year.
     
@@ -28,45 +45,62 @@ def calc_proportion(level, year):
             "unhealthy": PM2.5 level ranging from 30 µg per cubic meter and above
             int: aqi of whatever the int is or above
         year: the year for which we query the data
+        sql_database: the sqlite database holding the PM25 table
+        max_error: float. accept proportions estimated from the PM25 histogram (see rollups.py) if they are off by at most this much,
+            for levels without an exact rollup. fast enough to follow a threshold slider (optional)
         
     Returns:
         a pandas data frame that contains the proportion of times a county experienced air quality above a certain `level`, as well as other variables necessary for plotting the air quality data.
     '''
     #set the air quality levels
-    if level == "moderate":
-        lower = 15
+    lower = level_threshold(level)
         
-    elif level == "unhealthy":
-        lower = 30
-    
-    else:
-        lower = level
-        
-    #interact with the sql database to get the relevant data
-    conn = sqlite3.connect('airpandas_1.sqlite')
+    #count the measurements above the threshold and all measurements of each county in one grouped query
+    #(on the pooled connection of the database, see database_query.Database)
+    database = dbq.connect(sql_database)
+    conn = database.connection()
+    rollup = database.rollup_for('PM25', [lower], year, year, op='ge')
+    estimate = None
+    if rollup is None and max_error is not None and database.query_builder().has_column(dbq.rollup_table('PM25', 'annual'), 'county'):
+        estimate = database.histogram_exceedance('PM25', lower, year, year, op='ge')
+        if estimate is not None and (estimate["error_bound"] > max_error).any():
+            estimate = None
 
-    df = pd.read_sql_query(f"SELECT sample_measurement, FIPS, county FROM PM25 WHERE year = {year}", conn)
-
-    conn.close()
+    if estimate is not None:
+        #the counts are estimated from the histogram, the county names come from the annual rollup
+        county_names = pd.read_sql_query(f'SELECT FIPS, county FROM "{dbq.rollup_table("PM25", "annual")}" WHERE year = ?',
+                                           conn, params=(year,))
+        df = estimate.drop(columns="error_bound").merge(county_names, on="FIPS", how="left")
+    elif rollup is not None:
+        #the counts are pre-aggregated by county and year (see rollups.py)
+        df = pd.read_sql_query(f"""
+            SELECT FIPS,
+                SUM({dbq.threshold_column('ge', lower)}) AS exceed_count,
+                SUM(count) AS total_count,
+                MIN(county) AS county
+            FROM "{rollup}"
+            WHERE year = ?
+            GROUP BY FIPS
+            """, conn, params=(year,))
+    else:
+        df = pd.read_sql_query("""
+            SELECT FIPS,
+                SUM(CASE WHEN sample_measurement >= ? THEN 1 ELSE 0 END) AS exceed_count,
+                COUNT(*) AS total_count,
+                MIN(county) AS county
+            FROM PM25
+            WHERE year = ?
+            GROUP BY FIPS
+            """, conn, params=(lower, year))
         
     #calculate the proportion of measurements with PM2.5 concentration above the specified threshold
-    r = list(df["FIPS"].unique())
-    s = list(df["FIPS"].unique())
-    j = 0
-            
-    for i in df["FIPS"].unique():
-        s[j] = len(df["sample_measurement"][(lower <= df["sample_measurement"]) & (df["FIPS"] == i)])
-        r[j] = len(df[df["FIPS"] == i])
-        j += 1
-            
-    df1 = pd.DataFrame(df["FIPS"].unique(), columns = ["FIPS"])
-    df1["values"] = [s / r for s, r in zip(s, r)]
-    df1["county"] = list(df["county"].unique())
+    df["values"] = df["exceed_count"] / df["total_count"]
         
-    return(df1)
+    return(df[["FIPS", "values", "county", "exceed_count", "total_count"]])
 
 
-def data_census(census_table, columns, year):
+@query_cache.memoize()
+def data_census(census_table, columns, year, sql_database='airpandas_1.sqlite'):
     '''
     queries desired variables from the relevant table in the airpandas_1 sqlite database in a given year
     
@@ -74,17 +108,31 @@ def data_census(census_table, columns, year):
         census_table: string. the table from the SQL database we want to work with.
         columns: list of strings. each string is a variable from the SQL database.
         year: int. the year for which we want to plot the data.
+        sql_database: the sqlite database holding the census table
         
     Returns:
         a pandas dataframe containing the desired variables
     '''
     
-    #interact with the sqlite database to retrieve the specified data
-    conn = sqlite3.connect('airpandas_1.sqlite')
+    #interact with the sqlite database to retrieve the specified data (names checked against the schema, see database_query.QueryBuilder)
+    database = dbq.connect(sql_database)
+    sql, params = database.query_builder().select(census_table, list(columns) + ["NAME", "FIPS"], year, year)
+
+    df = pd.read_sql_query(sql, database.connection(), params=params)
+    df.columns = list(columns) + ["NAME", "FIPS"]
+    
+    return(census_values(df, columns))
 
-    df = pd.read_sql_query(f"SELECT {', '.join(columns)}, NAME, FIPS FROM {census_table} WHERE year = {year}", conn)
 
-    conn.close()
+def census_values(df, columns):
+    '''
+    cleans the county names of census data and adds the plotted `values` column, the sum of `columns`
+    
+    Args:
+        df: a pandas dataframe with the census `columns`, NAME and FIPS
+        columns: list of strings. the census variables to sum.
+    '''
+    df = df[list(columns) + ["NAME", "FIPS"]].copy()
     
     #clean the county names to fit the format of the future plot
     df["NAME"] = df["NAME"].str[:-19]
@@ -98,7 +146,7 @@ def data_census(census_table, columns, year):
         return(df)
     
     
-def add_aqi_trace(fig, df, variable, FIPS, county_name):
+def add_aqi_trace(fig, df, variable, FIPS, county_name, geojson=None):
     '''
     adds a choropleth subplot to a plotly figure with county-level air quality data
     
@@ -108,10 +156,12 @@ def add_aqi_trace(fig, df, variable, FIPS, county_name):
         variable: the air quality variable we want to display on the choropleth map
         FIPS: the FIPS codes associated with each county
         county_name: a column specifying the names of each county
+        geojson: the county geometry, or the url of a GeoJSON file (optional, the counties of df by default)
     '''
     
+    #only the counties plotted, simplified (see geometry.py)
     fig.add_trace(go.Choropleth(z = df[variable], 
-                                geojson=counties, 
+                                geojson=geometry.county_geometry(df[FIPS]) if geojson is None else geojson, 
                                 locations= df[FIPS],
                                 text=df[county_name],
                                 hovertemplate = "<b>County: %{text}</b><br><br>" + "value: %{z}<br>"
@@ -125,7 +175,7 @@ def add_aqi_trace(fig, df, variable, FIPS, county_name):
     )
     
     
-def add_census_trace(fig, df, variable, variable_name, FIPS, county_name):
+def add_census_trace(fig, df, variable, variable_name, FIPS, county_name, geojson=None):
     
     '''
     adds a choropleth subplot to a plotly figure with county-level census data
@@ -136,10 +186,11 @@ def add_census_trace(fig, df, variable, variable_name, FIPS, county_name):
         variable: the census variable we want to display on the chropleth map
         FIPS: the fips codes are associated with each county
         county_name: a column specitying the names of each county
+        geojson: the county geometry, or the url of a GeoJSON file (optional, the counties of df by default)
     '''
     
     fig.add_trace(go.Choropleth(z = df[variable], 
-                                geojson=counties, 
+                                geojson=geometry.county_geometry(df[FIPS]) if geojson is None else geojson, 
                                 locations= df[FIPS], 
                                 text=df[county_name],
                                 hovertemplate = "<b>County: %{text}</b><br><br>" + "value: %{z}<br>",
@@ -154,19 +205,22 @@ def add_census_trace(fig, df, variable, variable_name, FIPS, county_name):
     )
     
 
-def create_side_comparison(level, year, census_table, census_columns):
+def side_comparison_figure(level, year, census_table, census_columns, aqi_df, census_df, geojson=None):
     
     '''
-    generates a figure comparing demographcs and air quality
+    generates a figure comparing demographics and air quality from data already queried
     
     Args:
-        level: an int or string giving the level of air quality index or above we want to include in the plot.
-        year: int. the year for which we want to plot the data.
-        census_table: string. the table from which we want to gather the census variable(s).
-        census_columns: list of strings. the columns from the `census_table` we want to select.
+        level: an int or string giving the level of air quality index or above in the plot.
+        year: int. the year of the data.
+        census_table: string. the table the census variable(s) come from.
+        census_columns: list of strings. the census variables summed in `census_df`.
+        aqi_df: the proportions of calc_proportion for the level and year
+        census_df: the census data of data_census for the columns and year
+        geojson: the county geometry, or the url of a GeoJSON file (optional, the counties plotted by default)
         
     Returns:
-        a plotly figure comparing the chosen demographics and air quality information in a given year
+        a plotly figure comparing the demographics and air quality information
     '''
     
     rows = 1
@@ -178,21 +232,320 @@ def create_side_comparison(level, year, census_table, census_columns):
         )
     
     #plotting the air quality subplot
-    add_aqi_trace(fig, calc_proportion(level, year), "values", "FIPS", "county")
+    add_aqi_trace(fig, aqi_df, "values", "FIPS", "county", geojson)
 
     #plotting the census subplot
-    add_census_trace(fig, data_census(census_table, census_columns, year), "values", "values", "FIPS", "NAME")
+    add_census_trace(fig, census_df, "values", "values", "FIPS", "NAME", geojson)
     
     fig.update_layout(coloraxis = {'colorscale':'viridis'})
     
-    fig.show()
+    return fig
+
+
+def create_side_comparison(level, year, census_table, census_columns, max_error=None, sql_database='airpandas_1.sqlite', show=True):
+    
+    '''
+    generates a figure comparing demographcs and air quality
+    
+    Args:
+        level: an int or string giving the level of air quality index or above we want to include in the plot.
+        year: int. the year for which we want to plot the data.
+        census_table: string. the table from which we want to gather the census variable(s).
+        census_columns: list of strings. the columns from the `census_table` we want to select.
+        max_error: float. the error accepted on the air quality proportions, see calc_proportion (optional)
+        sql_database: the sqlite database holding the PM25 and census tables
+        show: bool. open the figure in the browser
+        
+    Returns:
+        a plotly figure comparing the chosen demographics and air quality information in a given year
+    '''
+    
+    fig = side_comparison_figure(level, year, census_table, census_columns,
+                                 calc_proportion(level, year, sql_database, max_error),
+                                 data_census(census_table, census_columns, year, sql_database))
+    
+    if show:
+        fig.show()
+    
+    return fig
+
+### compact report export -- many comparisons on one page, the geometry written once
+
+def comparison_figure(level, years, census_table, census_columns, sql_database='airpandas_1.sqlite', geojson=None, max_error=None):
+    '''
+    generates a side comparison figure (see create_side_comparison) with a slider over the years.
+    every year is an animation frame holding only the values, the geometry stays in the two traces.
+
+    Args:
+        level: an int or string giving the level of air quality index or above we want to include in the plot.
+        years: list of ints. the years on the slider.
+        census_table: string. the table from which we want to gather the census variable(s).
+        census_columns: list of strings. the columns from the `census_table` we want to select.
+        sql_database: the sqlite database holding the PM25 and census tables
+        geojson: the county geometry or the url of a GeoJSON file (optional, the counties plotted in any year by default)
+        max_error: float. the error accepted on the air quality proportions, see calc_proportion (optional)
+
+    Returns:
+        a plotly figure with one frame per year
+    '''
+    aqi = {year: calc_proportion(level, year, sql_database, max_error) for year in years}
+    census = {year: data_census(census_table, census_columns, year, sql_database) for year in years}
+
+    fig = make_subplots(
+        rows=1, cols=2,
+        specs = [[{'type': 'choropleth'}, {'type': 'choropleth'}]],
+        subplot_titles = [f"Census: {' + '.join(census_columns)}", f"Proportion with PM2.5 above level '{level}'"]
+        )
+
+    #the geometry of the counties of every year, the traces keep it for all the frames
+    if geojson is None:
+        geojson = geometry.county_geometry(set().union(*(df["FIPS"] for df in list(aqi.values()) + list(census.values()))))
+
+    first = years[0]
+    add_aqi_trace(fig, aqi[first], "values", "FIPS", "county", geojson)
+    add_census_trace(fig, census[first], "values", "values", "FIPS", "NAME", geojson)
+
+    #the same color range for every year, so the years can be compared
+    fig.update_traces(zmin=min(df["values"].min() for df in aqi.values()), zmax=max(df["values"].max() for df in aqi.values()), selector=0)
+    fig.update_traces(zmin=min(df["values"].min() for df in census.values()), zmax=max(df["values"].max() for df in census.values()), selector=1)
+
+    fig.frames = [go.Frame(name=str(year),
+                           data=[go.Choropleth(z=aqi[year]["values"], locations=aqi[year]["FIPS"], text=aqi[year]["county"]),
+                                 go.Choropleth(z=census[year]["values"], locations=census[year]["FIPS"], text=census[year]["NAME"])],
+                           traces=[0, 1])
+                  for year in years]
+
+    fig.update_layout(
+        title=f"{census_table} and air quality",
+        sliders=[{"currentvalue": {"prefix": "Year: "},
+                  "steps": [{"label": str(year), "method": "animate",
+                             "args": [[str(year)], {"mode": "immediate", "frame": {"duration": 0, "redraw": True}, "transition": {"duration": 0}}]}
+                            for year in years]}])
+    return fig
+
+def export_comparisons(comparisons, years, level, output_file, sql_database='airpandas_1.sqlite', geometry_mode='inline',
+                       include_plotlyjs='cdn', max_error=None):
+    '''
+    writes many side comparisons to a single HTML page, each with a year slider, with the county geometry written once:
+    "inline" embeds it once in the page and every trace points to it, "external" writes it next to the page
+    (output_file with a .geojson extension) and every trace loads it by url -- pages opened from the disk
+    need a browser that allows it, or a local web server.
+
+    Args:
+        comparisons: list of (census_table, census_columns) tuples.
+        years: list of ints. the years on the sliders.
+        level: an int or string giving the level of air quality index or above we want to include in the plot.
+        output_file: string. the HTML file to write.
+        sql_database: the sqlite database holding the PM25 and census tables
+        geometry_mode: "inline" or "external"
+        include_plotlyjs: "cdn" to load plotly.js from the web, True to embed it (once) in the page
+        max_error: float. the error accepted on the air quality proportions, see calc_proportion (optional)
+
+    Returns:
+        the list of files written
+    '''
+    if geometry_mode not in ("inline", "external"):
+        raise ValueError(f"Unknown geometry mode: {geometry_mode}")
+
+    geojson_file = os.path.splitext(output_file)[0] + ".geojson"
+    placeholder = os.path.basename(geojson_file) #the url in external mode, replaced by the embedded geometry inline
+
+    figures = [comparison_figure(level, years, table, columns, sql_database, placeholder, max_error) for table, columns in comparisons]
+
+    #only the counties present in any of the figures
+    fips_codes = set()
+    for fig in figures:
+        for frame in fig.frames:
+            for trace in frame.data:
+                fips_codes.update(trace.locations)
+    counties_geometry = json.dumps(geometry.county_geometry(fips_codes), separators=(',', ':'))
+
+    if include_plotlyjs == 'cdn':
+        plotly_script = f'<script src="https://cdn.plot.ly/plotly-{plotly.offline.get_plotlyjs_version()}.min.js"></script>'
+    else:
+        plotly_script = f'<script>{plotly.offline.get_plotlyjs()}</script>'
+
+    parts = ['<html>', '<head><meta charset="utf-8">', plotly_script, '</head>', '<body>']
+    if geometry_mode == "inline":
+        parts.append(f'<script>var counties = {counties_geometry};</script>')
+    else:
+        with open(geojson_file, 'w') as file:
+            file.write(counties_geometry)
+
+    for i, fig in enumerate(figures):
+        assign = "figure.data.forEach(function (trace) { trace.geojson = counties; });" if geometry_mode == "inline" else ""
+        parts.append(f'''<div id="comparison-{i}" style="height:600px"></div>
+<script>
+(function () {{
+    var figure = {fig.to_json()};
+    {assign}
+    Plotly.newPlot("comparison-{i}", figure.data, figure.layout).then(function () {{ Plotly.addFrames("comparison-{i}", figure.frames); }});
+}})();
+</script>''')
+
+    parts.extend(['</body>', '</html>'])
+    with open(output_file, 'w', encoding='utf-8') as file:
+        file.write("\n".join(parts))
+
+    return [output_file] if geometry_mode == "inline" else [output_file, geojson_file]
+
+
+### batch rendering -- a grid of comparisons from a few grouped queries, rendered on worker processes
+
+def batch_proportions(levels, years, sql_database='airpandas_1.sqlite'):
+    '''
+    calculates the proportions of calc_proportion for every level and year in one grouped query
+    (on the annual rollup when it counts every level, see rollups.py, otherwise on PM25)
+    
+    Args:
+        levels: list of ints or strings. the air quality levels, see calc_proportion.
+        years: list of ints. the years.
+        sql_database: the sqlite database holding the PM25 table
+        
+    Returns:
+        a dictionary {(level, year): data frame}, the data frames being those of calc_proportion
+    '''
+    thresholds = [level_threshold(level) for level in levels]
+    years = sorted(set(int(year) for year in years))
+    if not years:
+        return {}
+    
+    database = dbq.connect(sql_database)
+    conn = database.connection()
+    rollup = database.rollup_for('PM25', thresholds, years[0], years[-1], op='ge')
+    year_marks = ", ".join("?" for _ in years)
+    
+    if rollup is not None:
+        counts = "".join(f", SUM({dbq.threshold_column('ge', threshold)}) AS exceed_{i}" for i, threshold in enumerate(thresholds))
+        df = pd.read_sql_query(f"""
+            SELECT year, FIPS, SUM(count) AS total_count, MIN(county) AS county{counts}
+            FROM "{rollup}"
+            WHERE year IN ({year_marks})
+            GROUP BY year, FIPS
+            """, conn, params=years)
+    else:
+        counts = "".join(f", SUM(CASE WHEN sample_measurement >= ? THEN 1 ELSE 0 END) AS exceed_{i}" for i in range(len(thresholds)))
+        df = pd.read_sql_query(f"""
+            SELECT year, FIPS, COUNT(*) AS total_count, MIN(county) AS county{counts}
+            FROM PM25
+            WHERE year IN ({year_marks})
+            GROUP BY year, FIPS
+            """, conn, params=thresholds + years)
+    
+    proportions = {}
+    for year, year_df in df.groupby("year"):
+        for i, level in enumerate(levels):
+            result = year_df.rename(columns={f"exceed_{i}": "exceed_count"}).reset_index(drop=True)
+            result["values"] = result["exceed_count"] / result["total_count"]
+            proportions[(level, int(year))] = result[["FIPS", "values", "county", "exceed_count", "total_count"]]
+    
+    return proportions
+
+
+def batch_census(census_table, columns_list, years, sql_database='airpandas_1.sqlite'):
+    '''
+    queries the census data of data_census for every set of columns and year in one query of the table
+    
+    Args:
+        census_table: string. the table from the SQL database.
+        columns_list: list of lists of strings. the sets of variables, each summed into one map.
+        years: list of ints. the years.
+        sql_database: the sqlite database holding the census table
+        
+    Returns:
+        a dictionary {(tuple of columns, year): data frame}, the data frames being those of data_census
+    '''
+    columns = list(dict.fromkeys(column for columns in columns_list for column in columns))
+    years = sorted(set(int(year) for year in years))
+    if not years:
+        return {}
+    
+    #the range of the years in one query (names checked against the schema, see database_query.QueryBuilder), then only the years asked
+    database = dbq.connect(sql_database)
+    sql, params = database.query_builder().select(census_table, columns + ["NAME", "FIPS", "Year"], years[0], years[-1])
+    df = pd.read_sql_query(sql, database.connection(), params=params)
+    df.columns = columns + ["NAME", "FIPS", "Year"]
+    df = df[df["Year"].isin(years)]
+    
+    census = {}
+    for year, year_df in df.groupby("Year"):
+        for columns in columns_list:
+            census[(tuple(columns), int(year))] = census_values(year_df.reset_index(drop=True), columns)
+    
+    return census
+
+
+def render_comparison(job):
+    '''
+    builds one side comparison figure and writes it to an HTML file, run on a worker process by render_comparisons
+    
+    Args:
+        job: a (output_file, level, year, census_table, census_columns, aqi_df, census_df, include_plotlyjs) tuple
+        
+    Returns:
+        the file written
+    '''
+    output_file, level, year, census_table, census_columns, aqi_df, census_df, include_plotlyjs = job
+    
+    fig = side_comparison_figure(level, year, census_table, census_columns, aqi_df, census_df)
+    fig.write_html(output_file, include_plotlyjs=include_plotlyjs)
+    
+    return output_file
+
+
+def comparison_file_name(census_table, census_columns, year, level):
+    name = f"{census_table}_{'+'.join(census_columns)}_comparison_{year}_{level}"
+    return re.sub(r"[^\w+.-]", "_", name) + ".html"
+
+
+def render_comparisons(comparisons, years, levels, output_dir='.', sql_database='airpandas_1.sqlite', workers=None, include_plotlyjs='cdn'):
+    '''
+    renders a side comparison figure (see create_side_comparison) for every census table and columns, year and level, to one HTML
+    file each. the data is queried up front -- one grouped query of PM25 for all the years and levels, one query per census table
+    for all its columns and years -- then the figures are built and written on a pool of worker processes.
+    
+    Args:
+        comparisons: list of (census_table, census_columns) tuples.
+        years: list of ints. the years.
+        levels: list of ints or strings. the air quality levels, see calc_proportion.
+        output_dir: string. the folder of the HTML files.
+        sql_database: the sqlite database holding the PM25 and census tables
+        workers: int. the number of worker processes (optional, one per CPU by default)
+        include_plotlyjs: "cdn" to load plotly.js from the web, True to embed it in every file
+        
+    Returns:
+        the list of files written, named <table>_<columns>_comparison_<year>_<level>.html
+    '''
+    proportions = batch_proportions(levels, years, sql_database)
+    
+    tables = {}
+    for census_table, census_columns in comparisons:
+        tables.setdefault(census_table, []).append(census_columns)
+    census = {}
+    for census_table, columns_list in tables.items():
+        for (columns, year), df in batch_census(census_table, columns_list, years, sql_database).items():
+            census[(census_table, columns, year)] = df
+    
+    #the years missing from PM25 or from a census table have nothing to plot
+    jobs = [(os.path.join(output_dir, comparison_file_name(census_table, census_columns, year, level)),
+             level, year, census_table, census_columns,
+             proportions[(level, year)], census[(census_table, tuple(census_columns), year)], include_plotlyjs)
+            for census_table, census_columns in comparisons
+            for year in years
+            for level in levels
+            if (level, year) in proportions and (census_table, tuple(census_columns), year) in census]
+    
+    #simplify the county geometry once, the workers read it from the disk cache (see geometry.py)
+    geometry.load_counties(geometry.map_tolerance)
+    os.makedirs(output_dir, exist_ok=True)
+    
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(render_comparison, jobs))
+
 
 ## A small show case of the functions here if you run this py file ##
 def main():
-    import database_query as dbq
-    dbq.create_index('airpandas_1.sqlite', 'PM25', 'year')
-    dbq.create_index('airpandas_1.sqlite', 'PM25', 'FIPS')
-    dbq.create_index('airpandas_1.sqlite', 'PM25', ['date_local', 'FIPS'])
+    index_manager.ensure_indexes('airpandas_1.sqlite')
 
     # Compare air quality with educational attainment and income
     census_tables = ['Education', 'Income']
@@ -200,9 +553,11 @@ def main():
     year = 2020
     level = "unhealthy"
 
-    for table, columns in zip(census_tables, census_columns):
-        fig, _ = create_side_comparison(level, year, table, columns)
-        fig.write_html(f"{table}_comparison_{year}.html") ## save the figure as html file
+    # one page with both comparisons and a year slider, the county geometry written once
+    export_comparisons(list(zip(census_tables, census_columns)), list(range(2009, year + 1)), level, f"comparison_2009-{year}.html")
+
+    # and one file per comparison, year and level
+    render_comparisons(list(zip(census_tables, census_columns)), [year - 1, year], ["moderate", level], "comparisons")
 
 
 if __name__ == "__main__":